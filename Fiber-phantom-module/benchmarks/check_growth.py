@@ -0,0 +1,73 @@
+"""
+Checks of filament growth on small volumes.
+
+    python benchmarks/check_growth.py                # 200 seeds
+    python benchmarks/check_growth.py --seeds 50
+
+Jagged c_curve filaments with a pipe wider than the volume step out of the volume within a
+block of checked points, which must end growth instead of reading voxels out of bounds.
+Every filament is stamped, and the check fails when stamping relabels a fiber voxel, as
+the collision check covers the voxels stamping writes. Exits 1 when a check fails.
+"""
+import os
+import sys
+import random
+import argparse
+import traceback
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiber_phantom.next_point_generator import NextPointGenerator
+from fiber_phantom.materials import is_fiber_label
+from fiber_phantom.occupancy import OccupancyGrid
+import fiber_phantom.generate_filaments as gf
+
+SHAPE = (64, 64, 64)
+RADIUS = 6
+PIPE_RADIUS = 100  # wider than the volume, so only the volume bounds stop growth
+
+def run_seed(seed, num_filaments=20):
+    # number of fiber voxels stamping relabelled
+    np.random.seed(seed)
+    random.seed(seed)
+    volume = np.zeros(SHAPE, dtype=np.uint8)
+    occupancy = OccupancyGrid(SHAPE)
+    generator = NextPointGenerator(mode='c_curve', radius=RADIUS, jaggedness_factor=0.6)
+    overwritten = 0
+    for _ in range(num_filaments):
+        filament = gf.generate_3d_filament(volume, generator, 4, 60, RADIUS, PIPE_RADIUS, 1.0, [1, 0, 0], occupancy)
+        if filament is None:
+            continue
+        # the voxels stamping is about to write, before it writes them
+        voxels = gf.filament_voxels(filament, RADIUS)
+        voxels = voxels[gf.voxels_within_bounds(voxels, SHAPE)]
+        overwritten += int(np.count_nonzero(is_fiber_label(volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]])))
+        gf.update_volume_with_filament(volume, filament, RADIUS, PIPE_RADIUS, occupancy=occupancy)
+    return overwritten
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check filament growth on small volumes.")
+    parser.add_argument("--seeds", type=int, default=200, help="seeds to run (default: 200)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures = 0
+    for seed in range(args.seeds):
+        try:
+            overwritten = run_seed(seed)
+        except Exception:
+            print(f"seed {seed}: growth raised")
+            traceback.print_exc()
+            failures += 1
+            continue
+        if overwritten:
+            print(f"seed {seed}: stamping relabelled {overwritten} fiber voxels")
+            failures += 1
+    print(f"{args.seeds - failures} of {args.seeds} seeds ok")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
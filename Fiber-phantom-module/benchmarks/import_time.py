@@ -0,0 +1,68 @@
+"""
+Import time of the command line and the generation core, measured with python -X importtime.
+
+    python benchmarks/import_time.py                 # check against the default budget
+    python benchmarks/import_time.py --budget 30     # in milliseconds
+
+Every module is imported in a fresh interpreter after numpy, so the time is what the
+package adds on top of it; the minimum over --repeat runs is compared with the budget.
+The check also fails when importing a module pulls in plotting, ASTRA or I/O backends,
+which are only to be imported where they are used. Exits 1 when a check fails.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'fiber_phantom.cli',
+    'fiber_phantom.generate_filaments',
+    'fiber_phantom.next_point_generator',
+    'fiber_phantom.defects',
+    'fiber_phantom.storage',
+]
+# imported on demand only
+HEAVY = ['scipy', 'matplotlib', 'mpl_toolkits', 'pylab', 'nibabel', 'h5py', 'astra']
+
+def import_profile(module):
+    # {module name: cumulative microseconds} of the imports done by `import module`
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import numpy; import {module}'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    seen_numpy, profile = False, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # numpy and its dependencies are reported before the module, and not counted
+        if seen_numpy:
+            profile[name] = int(cumulative)
+        seen_numpy = seen_numpy or name == 'numpy'
+    return profile
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of the fiber_phantom modules.")
+    parser.add_argument("--budget", type=float, default=100.0, help="milliseconds per module on top of numpy (default: 100)")
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module, the fastest counts (default: 5)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures = 0
+    for module in MODULES:
+        profiles = [import_profile(module) for _ in range(args.repeat)]
+        milliseconds = min(profile[module] for profile in profiles) / 1e3
+        heavy = sorted({name for name in profiles[0] if name.split('.')[0] in HEAVY})
+        status = 'ok'
+        if milliseconds > args.budget:
+            status = f'over the {args.budget:g} ms budget'
+        if heavy:
+            status = f"imports {', '.join(heavy)}"
+        failures += status != 'ok'
+        print(f"{module:<40} {milliseconds:8.1f} ms   {status}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
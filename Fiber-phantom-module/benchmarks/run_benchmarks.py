@@ -0,0 +1,296 @@
+"""
+Timings of the phantom generation hot paths, at several volume sizes and with fixed seeds.
+
+    python benchmarks/run_benchmarks.py                          # all benchmarks at 64, 128 and 256
+    python benchmarks/run_benchmarks.py --sizes 64 --filter defect
+    python benchmarks/run_benchmarks.py --save baseline.json     # store a baseline
+    python benchmarks/run_benchmarks.py --compare baseline.json  # exit 1 on regressions
+
+Every benchmark has a setup, which is not timed, and a timed run; the median and minimum
+over --repeat runs are reported. The CPU tomography benchmark only runs when ASTRA is installed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fiber_phantom.next_point_generator import NextPointGenerator
+from fiber_phantom.defects import DefectGenerator
+from fiber_phantom.materials import is_fiber_label
+from fiber_phantom.occupancy import OccupancyGrid
+import fiber_phantom.generate_filaments as gf
+
+SEED = 1234
+MODES = ['straight', 'c_curve', 'kink_curve', 'full_wave_curve', 'half_wave_curve']
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    # registers fn(size) -> (setup, run); run(setup()) is what gets timed
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+def seed(value=SEED):
+    np.random.seed(value)
+    random.seed(value)
+
+def scaled(size):
+    # parameters.json is tuned for 256^3 volumes; lengths and radii scale with the size
+    return dict(
+        shape=(size, size, size),
+        pipe_radius=int(size * 125 / 256),
+        min_length=max(int(size * 80 / 256), 4),
+        max_length=max(int(size * 200 / 256), 8),
+        radius_range=(3, 6),
+    )
+
+def make_generator(mode, shape):
+    kwargs = {'volume_shape': shape} if mode == 'straight' else {}
+    generator = NextPointGenerator(mode=mode, **kwargs)
+    generator.cluster_center = [n // 2 for n in shape]
+    generator.cluster_radius = shape[0] // 4
+    return generator
+
+def filled_volume(size, num_filaments=None):
+    # a volume with filaments placed, the starting point of most of the later stages
+    p = scaled(size)
+    seed()
+    volume = np.zeros(p['shape'], dtype=np.uint8)
+    num_filaments = num_filaments or size * 2
+    generator = make_generator('kink_curve', p['shape'])
+    occupancy = OccupancyGrid(p['shape'])
+    for _ in range(num_filaments):
+        filament = gf.generate_3d_filament(volume, generator, p['min_length'], p['max_length'], 3, p['pipe_radius'], 1.0, [1, 0, 0], occupancy)
+        if filament is not None:
+            gf.update_volume_with_filament(volume, filament, 3, p['pipe_radius'], occupancy=occupancy)
+    return volume
+
+def random_centers(shape, count, margin=6):
+    rng = np.random.default_rng(SEED)
+    return rng.integers(margin, np.array(shape) - margin, size=(count, 3))
+
+
+@benchmark('can_place_sphere')
+def bench_can_place_sphere(size):
+    p = scaled(size)
+    volume = filled_volume(size)
+    occupancy = OccupancyGrid.from_mask(is_fiber_label(volume))
+    centers = random_centers(p['shape'], 1000)
+
+    def run(_):
+        for center in centers:
+            gf.can_place_sphere(center, volume, 3, p['pipe_radius'], occupancy)
+    return (lambda: None), run
+
+@benchmark('add_voxel_sphere_to_volume')
+def bench_add_voxel_sphere(size):
+    p = scaled(size)
+    centers = random_centers(p['shape'], 1000)
+
+    def run(volume):
+        for center in centers:
+            gf.add_voxel_sphere_to_volume(volume, center, 3, p['pipe_radius'])
+    return (lambda: np.zeros(p['shape'], dtype=np.uint8)), run
+
+def bench_generate_3d_filament(mode):
+    def bench(size):
+        p = scaled(size)
+
+        def setup():
+            seed()
+            return np.zeros(p['shape'], dtype=np.uint8), make_generator(mode, p['shape']), OccupancyGrid(p['shape'])
+
+        def run(state):
+            volume, generator, occupancy = state
+            for _ in range(50):
+                gf.generate_3d_filament(volume, generator, p['min_length'], p['max_length'], 3, p['pipe_radius'], 1.0, [1, 0, 0], occupancy)
+        return setup, run
+    return bench
+
+for _mode in MODES:
+    benchmark(f'generate_3d_filament[{_mode}]')(bench_generate_3d_filament(_mode))
+
+def bench_fill_pipe_with_resin(threads):
+    def bench(size):
+        p = scaled(size)
+        volume = filled_volume(size)
+        return volume.copy, lambda v: gf.fill_pipe_with_resin(v, p['pipe_radius'], threads)
+    return bench
+
+# threads None uses every core
+benchmark('fill_pipe_with_resin')(bench_fill_pipe_with_resin(1))
+benchmark('fill_pipe_with_resin[threads=all]')(bench_fill_pipe_with_resin(None))
+
+def bench_labels_to_attenuation(threads):
+    def bench(size):
+        from fiber_phantom.materials import labels_to_attenuation
+
+        volume = filled_volume(size)
+        gf.fill_pipe_with_resin(volume, scaled(size)['pipe_radius'])
+        out = np.empty(volume.shape, dtype=np.float32)
+        return (lambda: None), lambda _: labels_to_attenuation(volume, out=out, threads=threads)
+    return bench
+
+benchmark('labels_to_attenuation')(bench_labels_to_attenuation(1))
+benchmark('labels_to_attenuation[threads=all]')(bench_labels_to_attenuation(None))
+
+def defect_params(defect_type, size):
+    c = size // 2
+    return {
+        'hole': [{'hole_center': [c, c, c], 'hole_radius': size // 8}],
+        'square_notch': [{'square_notch_center': [c, size // 8], 'square_notch_wh': size // 16}],
+        'double_square_notch': [{'square_notch_center': [c, size // 8], 'square_notch_wh': size // 16}],
+        'v_notch': [{'v_notch_center': [c, size // 8], 'v_notch_height': size // 8, 'v_notch_width': size // 8}],
+        'double_v_notch': [{'v_notch_center': [c, size // 8], 'v_notch_height': size // 8, 'v_notch_width': size // 8}],
+        'reduced': [{'reduced_center': [c, c], 'reduced_radius': size // 3, 'reduced_slice_thickness': size // 8}],
+    }[defect_type]
+
+def bench_defect(defect_type):
+    def bench(size):
+        volume = filled_volume(size)
+        gf.fill_pipe_with_resin(volume, scaled(size)['pipe_radius'])
+        defects = DefectGenerator(defect_type=defect_type, params=defect_params(defect_type, size))
+        return volume.copy, defects.apply
+    return bench
+
+for _defect in ['hole', 'square_notch', 'double_square_notch', 'v_notch', 'double_v_notch', 'reduced']:
+    benchmark(f'defect_apply[{_defect}]')(bench_defect(_defect))
+
+@benchmark('add_many_small_resin_voids')
+def bench_add_many_small_resin_voids(size):
+    p = scaled(size)
+    volume = filled_volume(size)
+    gf.fill_pipe_with_resin(volume, p['pipe_radius'])
+
+    def setup():
+        seed()
+        return volume.copy()
+    return setup, lambda v: gf.add_many_small_resin_voids(v, 50, p['pipe_radius'], void_radius=1)
+
+@benchmark('generate_and_count_filaments')
+def bench_generate_and_count_filaments(size):
+    p = scaled(size)
+    centers = [[size // 2] * 3, [size * 2 // 3] * 3, [size // 3] * 3]
+    radii = [size // 16, size // 8, size // 12]
+
+    def setup():
+        seed()
+        return np.zeros(p['shape'], dtype=np.uint8)
+
+    def run(volume):
+        gf.generate_and_count_filaments(volume, size, NextPointGenerator(mode='kink_curve'),
+                                        DefectGenerator(defect_type='hole', params=defect_params('hole', size)),
+                                        p['pipe_radius'], p['min_length'], p['max_length'], p['radius_range'], 1.0,
+                                        cluster_centers=centers, cluster_radii=radii, cluster_percentages=[20, 50, 30])
+    return setup, run
+
+@benchmark('rasterize')
+def bench_rasterize(size):
+    # rebuilding the volume of generate_and_count_filaments from its recorded geometry
+    from fiber_phantom.geometry import FilamentGeometry, rasterize
+
+    p = scaled(size)
+    seed()
+    geometry = FilamentGeometry(p['shape'], p['pipe_radius'])
+    defects = DefectGenerator(defect_type='hole', params=defect_params('hole', size))
+    gf.generate_and_count_filaments(np.zeros(p['shape'], dtype=np.uint8), size, NextPointGenerator(mode='kink_curve'), defects,
+                                    p['pipe_radius'], p['min_length'], p['max_length'], p['radius_range'], 1.0,
+                                    cluster_centers=[[size // 2] * 3, [size * 2 // 3] * 3, [size // 3] * 3],
+                                    cluster_radii=[size // 16, size // 8, size // 12], cluster_percentages=[20, 50, 30],
+                                    geometry=geometry)
+    return (lambda: None), lambda _: rasterize(geometry, defect_generator=defects)
+
+@benchmark('cpu_tomography')
+def bench_cpu_tomography(size):
+    import fiber_phantom.cpu_tomography as cpu
+    from fiber_phantom.materials import labels_to_attenuation
+
+    volume = filled_volume(size)
+    gf.fill_pipe_with_resin(volume, scaled(size)['pipe_radius'])
+    attenuation = labels_to_attenuation(volume)
+    angles = np.linspace(0, np.pi, 30, False)
+
+    def run(_):
+        sinogram = cpu.create_sino3d_cpu(attenuation, angles, 1.0, 1.0, size, size)
+        cpu.reconstruct3d_cpu(sinogram, attenuation.shape, angles, 1.0, 1.0, 'SIRT3D_CUDA', iterations=20)
+    return (lambda: None), run
+
+def astra_available():
+    try:
+        import astra  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def time_benchmark(fn, size, repeat):
+    setup, run = fn(size)
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'repeat': repeat}
+
+def compare(results, baseline, threshold):
+    # a benchmark regressed when its median is more than threshold times the baseline median
+    regressions = []
+    for key, result in results.items():
+        if key in baseline:
+            ratio = result['median'] / baseline[key]['median']
+            flag = 'REGRESSION' if ratio > threshold else ''
+            print(f"    {key:<50} {ratio:6.2f}x baseline {flag}")
+            if ratio > threshold:
+                regressions.append(key)
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the phantom generation hot paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256], help="volume edge lengths (default: 64 128 256)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark (default: 5)")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains this string")
+    parser.add_argument("--save", default=None, help="write the results to this JSON file, e.g. as a baseline")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare the results against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="median / baseline ratio counted as a regression (default: 1.25)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name for name in BENCHMARKS if args.filter is None or args.filter in name]
+    if 'cpu_tomography' in names and not astra_available():
+        print("ASTRA is not installed, skipping cpu_tomography")
+        names.remove('cpu_tomography')
+
+    results = {}
+    for size in args.sizes:
+        for name in names:
+            key = f"{name}@{size}"
+            results[key] = time_benchmark(BENCHMARKS[name], size, args.repeat)
+            print(f"{key:<54} median {results[key]['median'] * 1e3:10.2f} ms   min {results[key]['min'] * 1e3:10.2f} ms")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'results': results}, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)['results']
+        print(f"Compared to {args.compare}:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold}x")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
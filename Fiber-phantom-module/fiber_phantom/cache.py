@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# bump when a change to the generation or tomography code changes what a stage produces,
+# so that artifacts of older code are not reused
+CACHE_VERSION = 2
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stage outputs (phantom, sinogram, noisy_sinogram,
+    reconstruction) in a local directory: arrays as .npy, dicts of arrays as .npz files. A stage's key hashes the parameters
+    that affect it together with the key of the stage it was computed from, so changing a
+    downstream parameter reuses every upstream artifact. Once the directory holds more than
+    max_bytes, the least recently used files are removed.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_params(cls, params):
+        # the cache is off unless parameters.json sets a cache_dir
+        if not params.get("cache_dir"):
+            return NullCache()
+        return cls(params["cache_dir"], int(params.get("cache_max_gb", 20) * 2**30))
+
+    def key(self, stage, params, upstream=""):
+        # None when the upstream stage has no key: what depends on it cannot be cached either
+        if upstream is None:
+            return None
+        text = json.dumps([CACHE_VERSION, stage, upstream, params], sort_keys=True, default=str)
+        return f"{stage}-{hashlib.sha256(text.encode()).hexdigest()}"
+
+    def path(self, key, extension=".npy"):
+        return os.path.join(self.directory, f"{key}{extension}")
+
+    def get(self, key):
+        for extension in (".npy", ".npz"):
+            try:
+                with open(self.path(key, extension), "rb") as file:
+                    loaded = np.load(file)
+                    array = dict(loaded) if isinstance(loaded, np.lib.npyio.NpzFile) else loaded
+                os.utime(self.path(key, extension))  # marks it as recently used
+                return array
+            except (OSError, ValueError):
+                # missing, or removed by another process in between
+                continue
+        return None
+
+    def put(self, key, array):
+        # written under a temporary name and renamed, so readers never see a partial file
+        temporary = os.path.join(self.directory, f".{key}-{os.getpid()}.tmp")
+        with open(temporary, "wb") as file:
+            if isinstance(array, dict):
+                np.savez(file, **array)
+            else:
+                np.save(file, array)
+        os.replace(temporary, self.path(key, ".npz" if isinstance(array, dict) else ".npy"))
+        self.evict()
+
+    def fetch(self, key, compute, stats=None):
+        # the cached array of key, or compute() stored under key; key None is never cached
+        if key is None:
+            return compute()
+        stage = key.split("-")[0]
+        array = self.get(key)
+        if array is not None:
+            if stats is not None:
+                stats.count(f"cache_hits_{stage}")
+            return array
+        array = compute()
+        self.put(key, array)
+        if stats is not None:
+            stats.count(f"cache_misses_{stage}")
+        return array
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npy", ".npz")) and not entry.name.startswith("."):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class NullCache:
+    # stands in for StageCache when caching is off: nothing is stored, everything is computed
+    def key(self, stage, params, upstream=""):
+        return None
+
+    def fetch(self, key, compute, stats=None):
+        return compute()
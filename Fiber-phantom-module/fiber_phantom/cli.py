@@ -0,0 +1,295 @@
+import os
+import glob
+import argparse
+import random
+import numpy as np
+import json
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing.util import Finalize
+
+from fiber_phantom.next_point_generator import NextPointGenerator
+from fiber_phantom.defects import DefectGenerator
+from fiber_phantom.materials import labels_to_attenuation
+from fiber_phantom.instrumentation import Instrumentation
+from fiber_phantom.cache import StageCache
+from fiber_phantom.geometry import FilamentGeometry
+from fiber_phantom.manifest import Manifest, merge_manifests, output_record, params_hash
+from fiber_phantom.storage import AsyncWriter, atomic_write, write_volume_hdf5
+import fiber_phantom.generate_filaments as gf
+
+# the parameters shipped with the package, read unless --params is given
+DEFAULT_PARAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parameters.json")
+
+# parameters that only affect the scan, the outputs or how the run is executed; every
+# other parameter, and the volume's seed, goes into the cache key of the phantom
+DOWNSTREAM_PARAMS = {
+    "random_seed", "num_volumes", "ASTRA_reconstruction", "num_angles", "geometry_type",
+    "det_width_u", "det_width_v", "det_count_x", "det_count_y", "i0", "i0_sweep",
+    "noise_realizations", "algorithm", "tomography_backend", "cpu_workers", "show_plots",
+    "save_nifti", "save_sinograms", "nifti_compression", "writer_threads", "max_pending_writes",
+    "source_origin", "origin_det", "cache_dir", "cache_max_gb", "volume_threads",
+}
+
+def phantom_params(params, random_seed):
+    phantom = {key: value for key, value in params.items() if key not in DOWNSTREAM_PARAMS}
+    phantom["seed"] = random_seed
+    return phantom
+
+def run_now(fn, *args, **kwargs):
+    future = Future()
+    future.set_result(fn(*args, **kwargs))
+    return future
+
+def complete_volume(entry, writes, outputs, stats, manifest=None):
+    # queued after the writes of the volume, so with several writer threads it may start
+    # while the last of them are still running
+    wait(writes)
+    if any(write.cancelled() or write.exception() is not None for write in writes):
+        return None  # the writer re-raises the error
+    entry["outputs"] = {os.path.basename(path): output_record(path) for path in outputs}
+    entry["instrumentation"] = stats.to_dict()
+    if manifest is not None:
+        manifest.record(entry)
+    return entry
+
+def create_session(params):
+    # ASTRA is only imported by runs that reconstruct
+    import fiber_phantom.perform_ASTRA as tomo
+    # geometries and ASTRA buffers are shared by every volume of the run
+    return tomo.TomographySession(
+        params["volume_dimensions"],
+        params["num_angles"],
+        params["geometry_type"],
+        params["det_width_u"],
+        params["det_width_v"],
+        params["det_count_x"],
+        params["det_count_y"],
+        params["algorithm"],
+        params["source_origin"],
+        params["origin_det"],
+        backend=params.get("tomography_backend", "cuda"),
+        workers=params.get("cpu_workers")
+    )
+
+# session of a worker process, opened once by init_worker
+worker_session = None
+
+def init_worker(params):
+    global worker_session
+    if params["ASTRA_reconstruction"]:
+        worker_session = create_session(params)
+        # worker processes skip atexit handlers, but run multiprocessing finalizers
+        Finalize(worker_session, worker_session.close, exitpriority=10)
+
+def generate_volume_in_worker(i, params, dataset_folder):
+    # the manifest entry is recorded by the main process
+    return generate_volume(i, params, dataset_folder, session=worker_session).result()
+
+def generate_volume(i, params, dataset_folder, writer=None, session=None, manifest=None):
+    # stage timings and counters of this volume, stored in its HDF5 file
+    stats = Instrumentation()
+    # with a writer the outputs are written in the background, otherwise right away
+    submit = writer.submit if writer is not None else run_now
+    writes, outputs = [], []
+
+    def write(file_path, fn):
+        # fn(path) writes one output, which is renamed to file_path once complete
+        outputs.append(file_path)
+        writes.append(submit(stats.timed('io', atomic_write), file_path, fn))
+
+    random_seed = params["random_seed"] + i  # different seed for each volume
+    # phantoms, sinograms and reconstructions are reused from the cache_dir if one is set
+    cache = StageCache.from_params(params)
+    phantom_key = cache.key('phantom', phantom_params(params, random_seed))
+
+    def generate():
+        # the phantom is generated as uint8 material labels, see fiber_phantom/materials.py
+        volume = np.zeros(params["volume_dimensions"], dtype=np.uint8)
+        # centerlines and voids, stored with the volume so it can be rasterized again
+        geometry = FilamentGeometry(params["volume_dimensions"], params["pipe_radius"])
+        # both RNGs are re-seeded per volume, so the output does not depend on which worker runs it
+        np.random.seed(random_seed)
+        random.seed(random_seed)
+
+        gf.generate_and_count_filaments(
+            volume,
+            params["num_filaments"],
+            NextPointGenerator(mode=params["generator_mode"]), #, volume_shape=params["volume_dimensions"]), # volume_shape can be removed if not 'straight'
+            DefectGenerator.from_params(params), # 'defect_type' can also be a list of types, e.g. ["hole", "v_notch"]
+            params["pipe_radius"],
+            params["min_length"],
+            params["max_length"],
+            params["radius_range"],
+            params["bias"],
+            stats=stats,
+            free_space_sampling=params.get("free_space_sampling", False),
+            num_voids=params.get("num_voids", 50),
+            void_radius=params.get("void_radius", 1),
+            threads=params.get("volume_threads", 1),
+            geometry=geometry
+        )
+        return {"phantom": volume, **geometry.to_arrays()}
+
+    phantom = cache.fetch(phantom_key, generate, stats)
+    volume = phantom.pop("phantom")
+    geometry = FilamentGeometry.from_arrays(phantom)
+
+    save_nifti = params.get("save_nifti", True)
+    save_sinograms = params.get("save_sinograms", False)
+    # nibabel gzips .nii.gz files, which happens on the writer threads
+    nifti_extension = ".nii.gz" if params.get("nifti_compression", False) else ".nii"
+
+    # float32 attenuation is only built here, for the NIfTI writer and ASTRA
+    if save_nifti or params["ASTRA_reconstruction"]:
+        with stats.stage('attenuation'):
+            attenuation = labels_to_attenuation(volume, threads=params.get("volume_threads", 1))
+
+    if save_nifti:
+        volume_filename = os.path.join(dataset_folder, f"filaments_volume_{i}{nifti_extension}")
+        write(volume_filename, partial(gf.save_as_nifti, attenuation))
+
+    reconstructions, sinograms, dataset_attrs = None, None, None
+    if params["ASTRA_reconstruction"]:
+        i0_sweep = params.get("i0_sweep")
+        # without a session one is opened for this volume only
+        with nullcontext(session) if session is not None else create_session(params) as tomography:
+            if i0_sweep:
+                # one forward projection, a noisy reconstruction per dose level and realization
+                original_recon, noisy, clean_sinogram = tomography.run_sweep(
+                    attenuation, i0_sweep, params.get("noise_realizations", 1), return_sinograms=save_sinograms, stats=stats,
+                    seed=random_seed, cache=cache, key=phantom_key)
+            else:
+                original_recon, noisy_recon, *projections = tomography.run(attenuation, params["i0"], return_sinograms=save_sinograms, stats=stats,
+                                                                       seed=random_seed, cache=cache, key=phantom_key)
+                noisy = [(params["i0"], 0, noisy_recon, projections[1] if save_sinograms else None)]
+                clean_sinogram = projections[0] if save_sinograms else None
+
+        # a single dose keeps the plain 'noisy' name; a sweep stores noisy_<k>, each with its i0
+        names = ["noisy"] if not i0_sweep else [f"noisy_{k}" for k in range(len(noisy))]
+        reconstructions = {"clean": original_recon}
+        reconstructions.update((name, reconstruction) for name, (_, _, reconstruction, _) in zip(names, noisy))
+        dataset_attrs = {name: {"i0": i0, "realization": realization} for name, (i0, realization, _, _) in zip(names, noisy)}
+        if save_sinograms:
+            sinograms = {"clean": clean_sinogram}
+            sinograms.update((name, sinogram) for name, (_, _, _, sinogram) in zip(names, noisy))
+
+        if save_nifti:
+            # Save the reconstructions in the FiberDataset folder
+            write(os.path.join(dataset_folder, f"original_reconstruction_{i}{nifti_extension}"), partial(gf.save_as_nifti, original_recon))
+            for name in names:
+                suffix = name[len("noisy"):]
+                write(os.path.join(dataset_folder, f"noisy_reconstruction_{i}{suffix}{nifti_extension}"), partial(gf.save_as_nifti, reconstructions[name]))
+
+    # Save volume and reconstructions data to HDF5 format in the FiberDataset folder
+    hdf5_filename = os.path.join(dataset_folder, f"volume_and_reconstruction_{i}.hdf5")
+    # the 'io' time stored in the file covers the writes of this volume finished before it
+    write(hdf5_filename, lambda path: write_volume_hdf5(path, volume, params, random_seed, reconstructions, sinograms, dataset_attrs=dataset_attrs, stats=stats, geometry=geometry))
+
+    # the volume counts as complete once its entry is in the manifest
+    entry = {"index": i, "seed": random_seed, "params_hash": params_hash(params)}
+    return submit(complete_volume, entry, writes, outputs, stats, manifest)
+
+# index of the first volume of a dataset
+FIRST_INDEX = 200
+
+def parse_shard(text):
+    try:
+        k, n = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected k/N, got {text!r}")
+    if not 0 <= k < n:
+        raise argparse.ArgumentTypeError(f"shard k/N needs 0 <= k < N, got {text!r}")
+    return k, n
+
+def shard_range(start, stop, shard):
+    # shard k of N gets the k-th of N contiguous, near equal parts of [start, stop)
+    k, n = shard
+    return range(start + (stop - start) * k // n, start + (stop - start) * (k + 1) // n)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="fiber-phantom", description="Generate a dataset of fiber phantoms.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes generating volumes in parallel (default: 1)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the volumes the manifest records as complete with the same parameters, generate the others")
+    parser.add_argument("--params", default=DEFAULT_PARAMS,
+                        help="parameter file (default: fiber_phantom/parameters.json)")
+    parser.add_argument("--output", default="FiberDataset",
+                        help="folder the dataset is written to (default: FiberDataset)")
+    parser.add_argument("--start", type=int, default=None,
+                        help=f"index of the first volume to generate (default: {FIRST_INDEX})")
+    parser.add_argument("--stop", type=int, default=None,
+                        help=f"index after the last volume to generate (default: {FIRST_INDEX} + num_volumes)")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="k/N",
+                        help="generate only part k of N (counted from 0) of the indices from --start to --stop")
+    parser.add_argument("--merge", action="store_true",
+                        help="combine the shard manifests in the output folder into its manifest.jsonl, then exit")
+    return parser.parse_args(argv)
+
+def merge(dataset_folder, indices):
+    # indices are the volumes the dataset should have, reported when missing
+    shard_manifests = sorted(glob.glob(os.path.join(dataset_folder, "manifest-*.jsonl")))
+    merged = merge_manifests(shard_manifests, os.path.join(dataset_folder, "manifest.jsonl"))
+    missing = sorted(set(indices) - {entry["index"] for entry in merged})
+    print(f"Merged {len(shard_manifests)} shard manifests: {len(merged)} volumes, {len(missing)} of {len(indices)} missing")
+    if missing:
+        print(f"Missing volumes: {missing}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_time = time.time()
+
+    dataset_folder = args.output
+    if not os.path.exists(dataset_folder):
+        os.makedirs(dataset_folder)
+
+    with open(args.params, "r") as file:
+        params = json.load(file)
+
+    # a volume's seed only depends on its index, so any split of the indices over shards
+    # gives the same dataset as a single run
+    start = FIRST_INDEX if args.start is None else args.start
+    stop = FIRST_INDEX + params["num_volumes"] if args.stop is None else args.stop
+    if args.merge:
+        return merge(dataset_folder, range(start, stop))
+
+    indices = range(start, stop) if args.shard is None else shard_range(start, stop, args.shard)
+
+    # every completed volume is recorded in the manifest, see fiber_phantom/manifest.py;
+    # a run over part of the indices has its own, combined with the others by --merge
+    partial_run = args.shard is not None or args.start is not None or args.stop is not None
+    manifest_name = f"manifest-{indices.start}-{indices.stop}.jsonl" if partial_run else "manifest.jsonl"
+    manifest = Manifest(os.path.join(dataset_folder, manifest_name))
+    if args.resume:
+        completed = manifest.resume(params_hash(params))
+        total = len(indices)
+        indices = [i for i in indices if i not in completed]
+        print(f"Resuming: {total - len(indices)} of {total} volumes already complete")
+    else:
+        manifest.reset()
+
+    if args.workers > 1:
+        # the workers overlap each other's compute and I/O, so they write right away
+        # each worker opens its own tomography session
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(params,)) as executor:
+            futures = [executor.submit(generate_volume_in_worker, i, params, dataset_folder) for i in indices]
+            # result() re-raises the first exception of any worker
+            for future in as_completed(futures):
+                manifest.record(future.result())
+    else:
+        # volume i is written while volume i + 1 is generated; leaving the block waits for
+        # the last writes and raises if any of them failed, then closes the session
+        with create_session(params) if params["ASTRA_reconstruction"] else nullcontext() as session, \
+                AsyncWriter(params.get("writer_threads", 1), params.get("max_pending_writes", 4)) as writer:
+            for i in indices:
+                generate_volume(i, params, dataset_folder, writer, session, manifest)
+
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+    print(f"Total processing time: {elapsed_time} seconds")
+
+if __name__ == "__main__":
+    main()
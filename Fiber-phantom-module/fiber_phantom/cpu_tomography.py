@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import astra
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# For parallel3d geometry every detector row only sees the volume slice at its height, so
+# the 3D problem splits into independent 2D parallel-beam problems that run on ASTRA's CPU
+# projectors, a slab of slices per worker process.
+
+# 3D (GPU) reconstruction algorithm -> 2D CPU algorithm run on every slice
+CPU_ALGORITHMS = {
+    'SIRT3D_CUDA': 'SIRT',
+    'CGLS3D_CUDA': 'CGLS',
+    'FDK_CUDA': 'FBP',  # FDK reduces to FBP for parallel beams
+    'SIRT': 'SIRT',
+    'SART': 'SART',
+    'CGLS': 'CGLS',
+    'FBP': 'FBP',
+}
+
+PROJECTOR = 'linear'
+
+def cpu_algorithm(algorithm):
+    if algorithm not in CPU_ALGORITHMS:
+        raise ValueError(f"Unknown algorithm for the CPU backend: {algorithm}")
+    return CPU_ALGORITHMS[algorithm]
+
+def detector_row_offset(num_slices, det_count_x, det_width_v):
+    # detector rows and volume slices are both centred on the rotation axis, so with unit
+    # row spacing detector row r sees slice r - offset
+    if det_width_v != 1.0:
+        raise ValueError("The CPU backend needs det_width_v == 1.0")
+    if (det_count_x - num_slices) % 2:
+        raise ValueError("The CPU backend needs det_count_x - number of slices to be even")
+    return (det_count_x - num_slices) // 2
+
+def slab_bounds(num_slices, num_slabs):
+    edges = np.linspace(0, num_slices, min(num_slabs, num_slices) + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+def default_workers(workers):
+    return workers or os.cpu_count() or 1
+
+def geometries_2d(slice_shape, angles, det_width_u, det_count_y):
+    vol_geom = astra.create_vol_geom(slice_shape[0], slice_shape[1])
+    proj_geom = astra.create_proj_geom('parallel', det_width_u, det_count_y, angles)
+    return vol_geom, proj_geom
+
+def project_slab(slab, angles, det_width_u, det_count_y):
+    vol_geom, proj_geom = geometries_2d(slab.shape[1:], angles, det_width_u, det_count_y)
+    projector_id = astra.create_projector(PROJECTOR, proj_geom, vol_geom)
+    sinograms = np.empty((slab.shape[0], len(angles), det_count_y), dtype=np.float32)
+    try:
+        for k, image in enumerate(slab):
+            sino_id, sinograms[k] = astra.create_sino(image, projector_id)
+            astra.data2d.delete(sino_id)
+    finally:
+        astra.projector.delete(projector_id)
+    return sinograms
+
+def reconstruct_slab(sinograms, slice_shape, angles, det_width_u, det_count_y, algorithm, iterations):
+    vol_geom, proj_geom = geometries_2d(slice_shape, angles, det_width_u, det_count_y)
+    projector_id = astra.create_projector(PROJECTOR, proj_geom, vol_geom)
+    slab = np.empty((len(sinograms),) + tuple(slice_shape), dtype=np.float32)
+    try:
+        for k, sinogram in enumerate(sinograms):
+            sino_id = astra.data2d.create('-sino', proj_geom, sinogram)
+            rec_id = astra.data2d.create('-vol', vol_geom)
+            alg_id = None
+            try:
+                cfg = astra.astra_dict(algorithm)
+                cfg['ProjectorId'] = projector_id
+                cfg['ProjectionDataId'] = sino_id
+                cfg['ReconstructionDataId'] = rec_id
+                alg_id = astra.algorithm.create(cfg)
+                astra.algorithm.run(alg_id, iterations)
+                slab[k] = astra.data2d.get(rec_id)
+            finally:
+                if alg_id is not None:
+                    astra.algorithm.delete(alg_id)
+                astra.data2d.delete([sino_id, rec_id])
+    finally:
+        astra.projector.delete(projector_id)
+    return slab
+
+def create_sino3d_cpu(volume, angles, det_width_u, det_width_v, det_count_x, det_count_y, workers=None, executor=None):
+    """
+    Parallel-beam forward projection of volume (slices, rows, cols) into an ASTRA parallel3d
+    sinogram (det_count_x, len(angles), det_count_y), a slab of slices per worker.
+    """
+    offset = detector_row_offset(volume.shape[0], det_count_x, det_width_v)
+    sinogram = np.zeros((det_count_x, len(angles), det_count_y), dtype=np.float32)
+    # slices that fall on the detector
+    first, last = max(0, -offset), min(volume.shape[0], det_count_x - offset)
+    bounds = [(first + start, first + stop) for start, stop in slab_bounds(last - first, 2 * default_workers(workers))]
+
+    slabs = (volume[start:stop] for start, stop in bounds)
+    results = map_slabs(project_slab, executor, workers, slabs, repeat(angles), repeat(det_width_u), repeat(det_count_y))
+    for (start, stop), rows in zip(bounds, results):
+        sinogram[start + offset:stop + offset] = rows
+    return sinogram
+
+def reconstruct3d_cpu(sinogram, volume_shape, angles, det_width_u, det_width_v, algorithm, iterations=200, workers=None, executor=None):
+    """
+    Slice-by-slice reconstruction of a parallel3d sinogram into a (slices, rows, cols) volume.
+    Slices outside the detector's rows stay 0.
+    """
+    algorithm = cpu_algorithm(algorithm)
+    det_count_x, det_count_y = sinogram.shape[0], sinogram.shape[2]
+    offset = detector_row_offset(volume_shape[0], det_count_x, det_width_v)
+    volume = np.zeros(volume_shape, dtype=np.float32)
+    first, last = max(0, -offset), min(volume_shape[0], det_count_x - offset)
+    bounds = [(first + start, first + stop) for start, stop in slab_bounds(last - first, 2 * default_workers(workers))]
+
+    rows = (sinogram[start + offset:stop + offset] for start, stop in bounds)
+    results = map_slabs(reconstruct_slab, executor, workers, rows, repeat(volume_shape[1:]), repeat(angles),
+                        repeat(det_width_u), repeat(det_count_y), repeat(algorithm), repeat(iterations))
+    for (start, stop), slab in zip(bounds, results):
+        volume[start:stop] = slab
+    return volume
+
+def map_slabs(fn, executor, workers, *iterables):
+    # runs on the given executor, or on a pool that only lives for this call
+    if executor is not None:
+        return list(executor.map(fn, *iterables))
+    if default_workers(workers) == 1:
+        return list(map(fn, *iterables))
+    with ProcessPoolExecutor(max_workers=default_workers(workers)) as pool:
+        return list(pool.map(fn, *iterables))
@@ -1,186 +1,238 @@
+import math
 import numpy as np
 
+from fiber_phantom.materials import defect_label
+from fiber_phantom.parallel import for_each_slab
+
+# parameters.json key holding the parameters of each defect type
+DEFECT_PARAMS_KEYS = {
+    'hole': 'hole_params',
+    'square_notch': 'square_notch_params',
+    'double_square_notch': 'square_notch_params',
+    'v_notch': 'v_notch_params',
+    'double_v_notch': 'v_notch_params',
+    'reduced': 'reduced_params',
+    'none': None,
+}
+
+def footprint_window(center, half_extent, size):
+    # integer coordinates c with abs(c - center) <= half_extent, clipped to [0, size)
+    start = max(math.ceil(center - half_extent), 0)
+    stop = min(math.floor(center + half_extent) + 1, size)
+    return np.arange(start, max(start, stop))
+
+def apply_footprint(volume, region, mask, label):
+    # mask broadcasts over volume[region] along the axis the defect is extruded in
+    np.copyto(volume[region], label, where=mask)
+
+def clip_footprint(region, mask, slab, length):
+    # the part of a footprint within the x slab, None if there is none; masks extruded
+    # along x have a single row
+    start, stop, _ = region[0].indices(length)
+    low, high = max(start, slab.start), min(stop, slab.stop)
+    if low >= high:
+        return None
+    if mask.shape[0] > 1:
+        mask = mask[low - start:high - start]
+    return (slice(low, high),) + tuple(region[1:]), mask
+
 class Defect:
-    def apply(self, volume):
+    def footprints(self, volume_shape):
+        # yields (region, mask) pairs: a bounding box of slices and a boolean footprint over it
         raise NotImplementedError("Subclasses should implement this method.")
 
+    def apply(self, volume, label=None):
+        # removed material gets a defect label, which maps to air attenuation
+        label = defect_label() if label is None else label
+        for region, mask in self.footprints(volume.shape):
+            apply_footprint(volume, region, mask, label)
+        return volume
+
+def box_region(xs, ys):
+    return (slice(xs[0], xs[-1] + 1), slice(ys[0], ys[-1] + 1), slice(None))
+
+def square_notch_footprint(volume_shape, x_center, y_center, half_width):
+    xs = footprint_window(x_center, half_width, volume_shape[0])
+    ys = footprint_window(y_center, half_width, volume_shape[1])
+    if len(xs) == 0 or len(ys) == 0:
+        return None
+    return box_region(xs, ys), np.ones((1, 1, 1), dtype=bool)
+
+def v_notch_footprint(volume_shape, x_center, y_center, height, half_width):
+    xs = footprint_window(x_center, height, volume_shape[0])
+    ys = footprint_window(y_center, half_width, volume_shape[1])
+    if len(xs) == 0 or len(ys) == 0:
+        return None
+    dx = np.abs(xs[:, None] - x_center)
+    mask = np.abs(ys[None, :] - y_center) <= half_width * (1 - dx / height)
+    return box_region(xs, ys), mask[:, :, None]
+
 class Hole(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             center = param['hole_center']
             radius = param['hole_radius']
 
-            for x in range(volume.shape[0]):
-                for y in range(volume.shape[1]): 
-                    for z in range(volume.shape[2]):
-                        if (x - center[0])**2 + (y - center[1])**2 <= radius**2: #distance bet point and the center of the hole
-                            volume[x, y, z] = 0
-
-        return volume
+            xs = footprint_window(center[0], radius, volume_shape[0])
+            ys = footprint_window(center[1], radius, volume_shape[1])
+            if len(xs) == 0 or len(ys) == 0:
+                continue
+            # distance bet point and the center of the hole, extruded along z
+            mask = (xs[:, None] - center[0])**2 + (ys[None, :] - center[1])**2 <= radius**2
+            yield box_region(xs, ys), mask[:, :, None]
 
 class SquareNotch(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             square_notch_center = param['square_notch_center']
             square_notch_wh = param["square_notch_wh"]  # half-width of the square notch
 
-            x_center, y_center = square_notch_center  
-            half_width = square_notch_wh
-
-            for x in range(volume.shape[0]):
-                if abs(x - x_center) <= half_width:
-                    for y in range(volume.shape[1]):
-                        if abs(y - y_center) <= half_width:
-                            for z in range(volume.shape[2]):
-                                volume[x, y, z] = 0
-
-        return volume
+            x_center, y_center = square_notch_center
+            footprint = square_notch_footprint(volume_shape, x_center, y_center, square_notch_wh)
+            if footprint is not None:
+                yield footprint
 
 class DoubleSquareNotch(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             square_notch_center = param['square_notch_center']
             square_notch_wh = param["square_notch_wh"]  # half-width of the square notch
 
-            x_center, y_center = square_notch_center 
-            half_width = square_notch_wh
-
-            # 1st notch
-            for x in range(volume.shape[0]):
-                if abs(x - x_center) <= half_width:
-                    for y in range(volume.shape[1]):
-                        if abs(y - y_center) <= half_width:
-                            for z in range(volume.shape[2]):
-                                volume[x, y, z] = 0
+            x_center, y_center = square_notch_center
 
             # calculate opposite side's center
-            x_opposite_center = volume.shape[0] - x_center - 1
-            y_opposite_center = volume.shape[1] - y_center - 1
-
-            # apply 2nd notch
-            for x in range(volume.shape[0]):
-                if abs(x - x_opposite_center) <= half_width:
-                    for y in range(volume.shape[1]):
-                        if abs(y - y_opposite_center) <= half_width:
-                            for z in range(volume.shape[2]):
-                                volume[x, y, z] = 0
+            x_opposite_center = volume_shape[0] - x_center - 1
+            y_opposite_center = volume_shape[1] - y_center - 1
 
-        return volume
+            for x, y in ((x_center, y_center), (x_opposite_center, y_opposite_center)):
+                footprint = square_notch_footprint(volume_shape, x, y, square_notch_wh)
+                if footprint is not None:
+                    yield footprint
 
 class VNotch(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             v_notch_center = param['v_notch_center']
-            v_notch_height = param["v_notch_height"] 
-            v_notch_width = param["v_notch_width"]  
-
-            x_center, y_center = v_notch_center 
-            height = v_notch_height
-            half_width = v_notch_width / 2
-
-            for x in range(volume.shape[0]):
-                for y in range(volume.shape[1]):
-                    if abs(x - x_center) <= height and abs(y - y_center) <= half_width * (1 - abs(x - x_center) / height):
-                        for z in range(volume.shape[2]):
-                            volume[x, y, z] = 0
+            v_notch_height = param["v_notch_height"]
+            v_notch_width = param["v_notch_width"]
 
-        return volume
+            x_center, y_center = v_notch_center
+            footprint = v_notch_footprint(volume_shape, x_center, y_center, v_notch_height, v_notch_width / 2)
+            if footprint is not None:
+                yield footprint
 
 class DoubleVNotch(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             v_notch_center = param['v_notch_center']
-            v_notch_height = param["v_notch_height"] 
-            v_notch_width = param["v_notch_width"] 
-
-            x_center, y_center = v_notch_center 
-            height = v_notch_height
-            half_width = v_notch_width / 2
+            v_notch_height = param["v_notch_height"]
+            v_notch_width = param["v_notch_width"]
 
-            # 1st notch
-            for x in range(volume.shape[0]):
-                for y in range(volume.shape[1]):
-                    if abs(x - x_center) <= height and abs(y - y_center) <= half_width * (1 - abs(x - x_center) / height):
-                        for z in range(volume.shape[2]):
-                            volume[x, y, z] = 0
+            x_center, y_center = v_notch_center
 
             # calculate opposite side's
-            x_opposite_center = volume.shape[0] - x_center - 1
-            y_opposite_center = volume.shape[1] - y_center - 1
+            x_opposite_center = volume_shape[0] - x_center - 1
+            y_opposite_center = volume_shape[1] - y_center - 1
 
-            # 2nd notch
-            for x in range(volume.shape[0]):
-                for y in range(volume.shape[1]):
-                    if abs(x - x_opposite_center) <= height and abs(y - y_opposite_center) <= half_width * (1 - abs(x - x_opposite_center) / height):
-                        for z in range(volume.shape[2]):
-                            volume[x, y, z] = 0
-
-        return volume
+            for x, y in ((x_center, y_center), (x_opposite_center, y_opposite_center)):
+                footprint = v_notch_footprint(volume_shape, x, y, v_notch_height, v_notch_width / 2)
+                if footprint is not None:
+                    yield footprint
 
 class Reduced(Defect):
     def __init__(self, params):
         self.params = params
 
-    def apply(self, volume):
+    def footprints(self, volume_shape):
         for param in self.params:
             center = param['reduced_center']
             reduced_radius = param['reduced_radius']
             slice_thickness = param['reduced_slice_thickness']
-            middle_slice = volume.shape[0] // 2
+            middle_slice = volume_shape[0] // 2
 
             # range of slices to be 0
-            start_slice = middle_slice - slice_thickness // 2
-            end_slice = middle_slice + slice_thickness // 2 + 1
+            start_slice = max(middle_slice - slice_thickness // 2, 0)
+            end_slice = min(middle_slice + slice_thickness // 2 + 1, volume_shape[0])
+            if start_slice >= end_slice:
+                continue
 
-            # iterate for the chosen slice
-            for x in range(start_slice, end_slice):
-                for y in range(volume.shape[1]):
-                    for z in range(volume.shape[2]):
-                        # 0 the volume, not the ones in the circle with reduced_radius
-                        if (y - center[0])**2 + (z - center[1])**2 > reduced_radius**2:
-                            volume[x, y, z] = 0
+            # 0 the volume, not the ones in the circle with reduced_radius; extruded along x
+            y = np.arange(volume_shape[1])[:, None]
+            z = np.arange(volume_shape[2])[None, :]
+            mask = (y - center[0])**2 + (z - center[1])**2 > reduced_radius**2
+            yield (slice(start_slice, end_slice), slice(None), slice(None)), mask[None, :, :]
 
-        return volume
-    
 class NoDefect(Defect):
-    def apply(self, volume):
-        return volume
+    def footprints(self, volume_shape):
+        return iter(())
+
+def create_defect(defect_type, params):
+    if defect_type == 'hole':
+        return Hole(params)
+    elif defect_type == 'square_notch':
+        return SquareNotch(params)
+    elif defect_type == 'double_square_notch':
+        return DoubleSquareNotch(params)
+    elif defect_type == 'v_notch':
+        return VNotch(params)
+    elif defect_type == 'double_v_notch':
+        return DoubleVNotch(params)
+    elif defect_type == 'reduced':
+        return Reduced(params)
+    elif defect_type == 'none':
+        return NoDefect()
+    else:
+        raise ValueError(f"Unknown type: {defect_type}")
 
 class DefectGenerator:
     def __init__(self, defect_type='hole', **kwargs):
+        # defect_type is a single type or a list of types; for a list, params holds one
+        # parameter list per type, in the same order
         self.defect_type = defect_type
         params = kwargs.get('params', {})
-        if defect_type == 'hole':
-            self.defect = Hole(params)
-        elif defect_type == 'square_notch':
-            self.defect = SquareNotch(params)
-        elif defect_type == 'double_square_notch':
-            self.defect = DoubleSquareNotch(params)
-        elif defect_type == 'v_notch':
-            self.defect = VNotch(params)
-        elif defect_type == 'double_v_notch':
-            self.defect = DoubleVNotch(params)
-        elif defect_type == 'reduced':
-            self.defect = Reduced(params)
-        elif defect_type == 'none':
-            self.defect = NoDefect()
+        if isinstance(defect_type, str):
+            self.defects = [create_defect(defect_type, params)]
         else:
-            raise ValueError(f"Unknown type: {self.defect_type}")
-
-    def apply(self, volume):
-        return self.defect.apply(volume)
\ No newline at end of file
+            if len(defect_type) != len(params):
+                raise ValueError("The number of defect types and defect parameters must be the same")
+            self.defects = [create_defect(t, p) for t, p in zip(defect_type, params)]
+
+    @classmethod
+    def from_params(cls, params):
+        # picks the matching '<type>_params' entries of parameters.json for each defect type
+        defect_type = params["defect_type"]
+        if isinstance(defect_type, str):
+            key = DEFECT_PARAMS_KEYS.get(defect_type)
+            return cls(defect_type=defect_type, params=params[key] if key else {})
+        return cls(defect_type=defect_type,
+                   params=[params[DEFECT_PARAMS_KEYS[t]] if DEFECT_PARAMS_KEYS.get(t) else {} for t in defect_type])
+
+    def apply(self, volume, threads=1):
+        # every footprint of every defect is applied in a single pass over the list,
+        # each defect with its own label; with several threads, per x slab
+        footprints = [(region, mask, defect_label(index))
+                      for index, defect in enumerate(self.defects)
+                      for region, mask in defect.footprints(volume.shape)]
+
+        def apply_slab(slab):
+            for region, mask, label in footprints:
+                clipped = clip_footprint(region, mask, slab, volume.shape[0])
+                if clipped is not None:
+                    apply_footprint(volume, *clipped, label)
+        for_each_slab(apply_slab, volume.shape[0], threads)
+        return volume
@@ -1,17 +1,17 @@
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
-import random
-from scipy.interpolate import splprep, splev
-import nibabel as nib
+from functools import lru_cache
 
-# Define the attenuation coefficients
-ATTENUATION_AIR = 0.0
-ATTENUATION_RESIN = 100.0
-ATTENUATION_FIBER = 255.0
+from fiber_phantom.materials import (LABEL_AIR, LABEL_RESIN, LABEL_FIBER, LABEL_VOID, fiber_label, is_fiber_label)
+from fiber_phantom.occupancy import OccupancyGrid
+from fiber_phantom.instrumentation import Instrumentation
+from fiber_phantom.parallel import for_each_slab
+
+# volumes hold uint8 material labels, see materials.py for the attenuation lookup
+# only numpy is imported with this module; scipy and nibabel are imported where used
 
 # Slicer reads .nii
 def save_as_nifti(array, file_path):
+    import nibabel as nib
     nifti_img = nib.Nifti1Image(array, affine=np.eye(4))  
     nib.save(nifti_img, file_path)
 
@@ -25,40 +25,287 @@ def is_within_pipe(point, center_y, center_z, pipe_radius):
     y, z = point[1], point[2]
     return ((y - center_y)**2 + (z - center_z)**2) <= pipe_radius**2
 
-def can_place_sphere(center, volume, radius, pipe_radius=50):
-    center_y, center_z = volume.shape[1] // 2, volume.shape[2] // 2
-    for x in range(-radius, radius + 1):
-        for y in range(-radius, radius + 1):
-            for z in range(-radius, radius + 1):
-                if x**2 + y**2 + z**2 <= radius**2:
-                    ix, iy, iz = center[0] + x, center[1] + y, center[2] + z
-                    if not is_within_bounds((ix, iy, iz), volume.shape, 0):
-                        return False
-                    if not is_within_pipe((ix, iy, iz), center_y, center_z, pipe_radius) or volume[ix, iy, iz] == ATTENUATION_FIBER:
-                        return False
-    return True
-
-def add_voxel_sphere_to_volume(volume, center, radius, pipe_radius=50, intensity=ATTENUATION_FIBER):
-    center_y, center_z = volume.shape[1] // 2, volume.shape[2] // 2
-    for x in range(-radius, radius + 1):
-        for y in range(-radius, radius + 1):
-            for z in range(-radius, radius + 1):
-                if x**2 + y**2 + z**2 <= radius**2:
-                    ix, iy, iz = center[0] + x, center[1] + y, center[2] + z
-                    if is_within_bounds((ix, iy, iz), volume.shape, 0) and is_within_pipe((ix, iy, iz), center_y, center_z, pipe_radius):
-                        volume[ix, iy, iz] = intensity
-
-def update_volume_with_filament(volume, filament, radius, pipe_radius=50, intensity=ATTENUATION_FIBER):
-    for point in filament:
-        add_voxel_sphere_to_volume(volume, point, radius, pipe_radius, intensity)
-
-def fill_pipe_with_resin(volume, pipe_radius=50):
-    center_y, center_z = volume.shape[1] // 2, volume.shape[2] // 2
-    for x in range(volume.shape[0]):
-        for y in range(volume.shape[1]):
-            for z in range(volume.shape[2]):
-                if volume[x, y, z] == 0.0 and is_within_pipe((x, y, z), center_y, center_z, pipe_radius):
-                    volume[x, y, z] = ATTENUATION_RESIN
+@lru_cache(maxsize=32)
+def sphere_offsets(radius):
+    # (N, 3) integer offsets of the voxels inside a sphere, computed once per radius
+    r = np.arange(-radius, radius + 1)
+    x, y, z = np.meshgrid(r, r, r, indexing='ij')
+    inside = x**2 + y**2 + z**2 <= radius**2
+    offsets = np.stack((x[inside], y[inside], z[inside]), axis=1)
+    offsets.flags.writeable = False
+    return offsets
+
+def sphere_voxels(center, radius):
+    return np.asarray(center, dtype=np.intp) + sphere_offsets(radius)
+
+@lru_cache(maxsize=1024)
+def segment_offsets(delta, radius):
+    # (N, 3) integer offsets within radius of the segment from 0 to delta that are not
+    # within radius of 0: what a capsule adds to the sphere at its start point
+    d = np.array(delta, dtype=float)
+    reach = radius + int(np.ceil(np.linalg.norm(d)))
+    r = np.arange(-reach, reach + 1)
+    grid = np.stack(np.meshgrid(r, r, r, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    # vectorized point-to-segment distances
+    length2 = d @ d
+    t = np.clip(grid @ d / length2, 0, 1) if length2 > 0 else np.zeros(len(grid))
+    distance2 = ((grid - t[:, None] * d)**2).sum(axis=1)
+
+    # voxels exactly on the capsule surface are kept, whatever the rounding of t
+    in_capsule = (distance2 <= radius**2 + 1e-9) | (((grid - np.array(delta))**2).sum(axis=1) <= radius**2)
+    offsets = grid[in_capsule & ((grid**2).sum(axis=1) > radius**2)]
+    offsets.flags.writeable = False
+    return offsets
+
+def filament_voxels(filament, radius):
+    # voxels of the union of capsules around the filament's centerline polyline: the sphere
+    # at the first point plus, for every segment, the voxels its capsule adds on top of that
+    points = np.asarray(filament, dtype=np.intp).reshape(-1, 3)
+    parts = [sphere_voxels(points[0], radius)]
+    if len(points) > 1:
+        # segments sharing a step vector share one cached kernel
+        deltas, inverse = np.unique(np.diff(points, axis=0), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for k, delta in enumerate(deltas):
+            starts = points[:-1][inverse == k]
+            parts.append((starts[:, None, :] + segment_offsets(tuple(delta.tolist()), radius)).reshape(-1, 3))
+    return np.concatenate(parts)
+
+def voxels_within_bounds(voxels, dimensions):
+    return np.all((voxels >= 0) & (voxels < np.asarray(dimensions[:3])), axis=1)
+
+@lru_cache(maxsize=8)
+def pipe_mask(volume_shape, pipe_radius):
+    # (y, z) cross-section of the pipe, shared by every x slice and every volume of the same shape
+    center_y, center_z = volume_shape[1] // 2, volume_shape[2] // 2
+    y = np.arange(volume_shape[1])[:, None]
+    z = np.arange(volume_shape[2])[None, :]
+    mask = (y - center_y)**2 + (z - center_z)**2 <= pipe_radius**2
+    mask.flags.writeable = False
+    return mask
+
+def voxels_within_pipe(voxels, volume_shape, pipe_radius):
+    # voxels must already be within bounds
+    return pipe_mask(tuple(volume_shape), pipe_radius)[voxels[:, 1], voxels[:, 2]]
+
+def placement_failure(center, volume, radius, pipe_radius=50, occupancy=None):
+    # why a sphere cannot be placed at center: 'bounds', 'pipe' or 'collision'; None if it can
+    voxels = sphere_voxels(center, radius)
+    if not voxels_within_bounds(voxels, volume.shape).all():
+        return 'bounds'
+    if not voxels_within_pipe(voxels, volume.shape, pipe_radius).all():
+        return 'pipe'
+    if occupancy is not None:
+        return 'collision' if occupancy.any(voxels) else None
+    return 'collision' if np.any(is_fiber_label(volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]])) else None
+
+def can_place_sphere(center, volume, radius, pipe_radius=50, occupancy=None):
+    return placement_failure(center, volume, radius, pipe_radius, occupancy) is None
+
+def point_failure(point, volume, radius, pipe_radius=50, occupancy=None):
+    # the checks every centerline point goes through, cheapest first
+    if not is_within_bounds(point, volume.shape, radius):
+        return 'bounds'
+    if not pipe_mask(volume.shape, pipe_radius)[point[1], point[2]]:
+        return 'pipe'
+    return placement_failure(point, volume, radius, pipe_radius, occupancy)
+
+def add_voxel_sphere_to_volume(volume, center, radius, pipe_radius=50, label=LABEL_FIBER, occupancy=None):
+    voxels = sphere_voxels(center, radius)
+    voxels = voxels[voxels_within_bounds(voxels, volume.shape)]
+    voxels = voxels[voxels_within_pipe(voxels, volume.shape, pipe_radius)]
+    volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = label
+    if occupancy is not None:
+        occupancy.mark(voxels)
+
+def update_volume_with_filament(volume, filament, radius, pipe_radius=50, label=LABEL_FIBER, occupancy=None):
+    voxels = filament_voxels(filament, radius)
+    voxels = voxels[voxels_within_bounds(voxels, volume.shape)]
+    voxels = voxels[voxels_within_pipe(voxels, volume.shape, pipe_radius)]
+    volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = label
+    if occupancy is not None:
+        occupancy.mark(voxels)
+
+def fiber_hits(voxels, volume, occupancy=None):
+    if occupancy is not None:
+        return occupancy.contains(voxels)
+    return is_fiber_label(volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]])
+
+FAILURES = (None, 'bounds', 'pipe', 'collision')
+
+def step_failures(points, previous, volume, radius, pipe_radius=50, occupancy=None):
+    """
+    Failure code per point, an index into FAILURES, for the (N, 3) centres points grown from
+    the centres previous, in growth order. The collision check reads the voxels the capsule
+    of a step adds to the sphere at previous, the same segment_offsets
+    update_volume_with_filament stamps, so an accepted filament never covers fiber voxels as
+    long as the sphere at previous was free. Points from the first bounds or pipe failure on
+    are not checked for collisions: their previous can be a point that failed, whose capsule
+    reaches out of the volume. Only codes up to the first failure are meaningful.
+    """
+    shape = volume.shape
+    codes = np.zeros(len(points), dtype=np.int8)
+    in_bounds = np.all((points >= radius) & (points < np.asarray(shape) - radius), axis=1)
+    codes[~in_bounds] = 1
+
+    # within bounds, the sphere lies in the pipe exactly where start_mask holds
+    candidates = np.flatnonzero(in_bounds)
+    in_pipe = start_mask(shape, pipe_radius, radius)[points[candidates, 1], points[candidates, 2]]
+    codes[candidates[~in_pipe]] = 2
+
+    # a point is grown from an earlier one, so up to the first failure every previous lies
+    # within the volume and the pipe
+    failed = np.flatnonzero(codes)
+    candidates = candidates[in_pipe]
+    if len(failed) > 0:
+        candidates = candidates[candidates < failed[0]]
+    steps = points[candidates] - previous[candidates]
+    # points taking the same step share a capsule kernel; steps are far shorter than 1024 voxels
+    keys = (steps[:, 0] * 2048 + steps[:, 1]) * 2048 + steps[:, 2]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    for k, index in enumerate(first):
+        group = candidates[inverse == k]
+        capsule = segment_offsets(tuple(steps[index].tolist()), radius)
+        if len(capsule) == 0:
+            continue
+        # the capsule between two spheres within the volume is within the volume as well
+        hits = fiber_hits((previous[group, None, :] + capsule).reshape(-1, 3), volume, occupancy)
+        codes[group[hits.reshape(len(group), -1).any(axis=1)]] = 3
+    return codes
+
+def chain_predecessors(at_start):
+    # index of the point each point of a centerline in growth order was grown from: the
+    # previous point at the same end, or the starting point 0
+    predecessors = np.zeros(len(at_start), dtype=np.intp)
+    for end in (at_start, ~at_start):
+        chain = np.flatnonzero(end)
+        chain = chain[chain > 0]
+        predecessors[chain[1:]] = chain[:-1]
+    return predecessors
+
+@lru_cache(maxsize=32)
+def start_mask(volume_shape, pipe_radius, radius):
+    # (y, z) centres whose sphere of radius lies within the volume and the pipe
+    mask = np.zeros(volume_shape[1:3], dtype=bool)
+    pipe = pipe_mask(volume_shape, pipe_radius)
+    ny, nz = volume_shape[1] - 2 * radius, volume_shape[2] - 2 * radius
+    if ny > 0 and nz > 0:
+        inner = np.ones((ny, nz), dtype=bool)
+        for dy, dz in np.unique(sphere_offsets(radius)[:, 1:], axis=0):
+            inner &= pipe[radius + dy:radius + dy + ny, radius + dz:radius + dz + nz]
+        mask[radius:radius + ny, radius:radius + nz] = inner
+    mask.flags.writeable = False
+    return mask
+
+class FreeSpaceIndex:
+    # Centres where a sphere of each filament radius fits without touching a fiber, so that
+    # starting points are drawn from free space instead of found by rejection.
+    # A centre is blocked for radius r when a fiber voxel lies within r of it, which is read
+    # off a Euclidean distance transform to the fiber voxels.
+    def __init__(self, volume_shape, pipe_radius, radii, fibers=None):
+        self.shape = tuple(volume_shape)
+        self.pipe_radius = pipe_radius
+        self.blocked = {r: OccupancyGrid(self.shape) for r in radii}
+        # free centres per x slice of every (radius, low, high) box sample has fallen back
+        # to, kept up to date by block so a fallback only unpacks one x slice
+        self.free_counts = {}
+        if fibers is not None and fibers.any():
+            self.block(fibers, (0, 0, 0))
+
+    def block(self, fibers, origin):
+        # fibers: bool mask of a box at origin that holds every centre within max(radii) of its fibers
+        from scipy.ndimage import distance_transform_edt
+        distance2 = np.rint(distance_transform_edt(~fibers)**2)
+        for r, grid in self.blocked.items():
+            blocked = distance2 <= r * r
+            self.uncount(r, origin, blocked)
+            grid.mark_region(origin, blocked)
+
+    def uncount(self, radius, origin, blocked):
+        # subtracts the centres that blocked, a mask of the box at origin, newly blocks from
+        # the free counts of the boxes of radius; called before blocked is marked
+        boxes = [key for key in self.free_counts if key[0] == radius]
+        if not boxes:
+            return
+        origin = np.asarray(origin)
+        end = origin + blocked.shape
+        x, y, z = (slice(l, h) for l, h in zip(origin, end))
+        mask = start_mask(self.shape, self.pipe_radius, radius)
+        newly = blocked & ~self.blocked[radius].region_mask(x, y, z) & mask[y, z]
+        for key in boxes:
+            low = np.maximum(key[1], origin)
+            high = np.minimum(np.asarray(key[2]) + 1, end)
+            if np.any(low >= high):
+                continue
+            part = newly[tuple(slice(l - o, h - o) for l, h, o in zip(low, high, origin))]
+            self.free_counts[key][low[0] - key[1][0]:high[0] - key[1][0]] -= part.sum(axis=(1, 2))
+
+    def add_filament(self, filament, radius, slab_width=32):
+        voxels = filament_voxels(filament, radius)
+        voxels = voxels[voxels_within_bounds(voxels, self.shape)]
+        voxels = voxels[voxels_within_pipe(voxels, self.shape, self.pipe_radius)]
+        # only the boxes around the filament's voxels can get blocked; a box per x slab
+        # keeps them tight around curved filaments
+        reach = max(self.blocked)
+        slabs = voxels[:, 0] // slab_width
+        for slab in np.unique(slabs):
+            part = voxels[slabs == slab]
+            low = np.maximum(part.min(axis=0) - reach, 0)
+            high = np.minimum(part.max(axis=0) + reach + 1, self.shape)
+            fibers = np.zeros(high - low, dtype=bool)
+            local = part - low
+            fibers[local[:, 0], local[:, 1], local[:, 2]] = True
+            self.block(fibers, tuple(low))
+
+    def sample(self, box, radius, batch_size=64):
+        """
+        Uniformly drawn centre within the inclusive (low, high) ranges of box where a sphere of
+        radius fits in the volume and the pipe and is not blocked, or None if there is none.
+        A batch of uniform candidates is tried first; when none of them is free, a free centre
+        is drawn from the free counts per x slice of the box, so a nearly full volume costs
+        the unpacking of one x slice instead of thousands of rejected attempts. The counts of
+        a box are enumerated on its first fallback and then updated as centres get blocked.
+        """
+        grid = self.blocked[radius]
+        mask = start_mask(self.shape, self.pipe_radius, radius)
+        low = np.maximum([b[0] for b in box], radius)
+        high = np.minimum([b[1] for b in box], np.asarray(self.shape) - radius - 1)
+        if np.any(low > high):
+            return None
+
+        candidates = np.random.randint(low, high + 1, size=(batch_size, 3))
+        free = mask[candidates[:, 1], candidates[:, 2]] & ~grid.contains(candidates)
+        if free.any():
+            return candidates[np.argmax(free)]
+
+        x, y, z = (slice(l, h + 1) for l, h in zip(low, high))
+        key = (radius, tuple(low.tolist()), tuple(high.tolist()))
+        if key not in self.free_counts:
+            self.free_counts[key] = (~grid.region_mask(x, y, z) & mask[y, z]).sum(axis=(1, 2))
+        counts = self.free_counts[key]
+        total = counts.sum()
+        if total == 0:
+            return None
+        # the rank-th free centre of the box in x, y, z order: its x slice from the counts,
+        # then its place among the free centres of that slice
+        rank = np.random.randint(total)
+        ends = np.cumsum(counts)
+        i = int(np.searchsorted(ends, rank, side='right'))
+        free = ~grid.region_mask(slice(low[0] + i, low[0] + i + 1), y, z)[0] & mask[y, z]
+        index = np.flatnonzero(free)[rank - (ends[i] - counts[i])]
+        return low + np.array((i, *np.unravel_index(index, free.shape)))
+
+def fill_pipe_with_resin(volume, pipe_radius=50, threads=1, slab_width=32):
+    # the (y, z) pipe mask broadcasts along x; slab by slab, which also keeps the
+    # temporaries small
+    pipe = pipe_mask(volume.shape, pipe_radius)
+
+    def fill(slab):
+        region = volume[slab]
+        np.copyto(region, LABEL_RESIN, where=(region == LABEL_AIR) & pipe)
+    for_each_slab(fill, volume.shape[0], threads, slab_width)
 
 def generate_radius_normal(radius_range, mean, std_dev):
     radius = np.random.normal(loc=mean, scale=std_dev)
@@ -67,7 +314,11 @@ def generate_radius_normal(radius_range, mean, std_dev):
     return int(radius)
 
 
-def generate_and_count_filaments(volume, num_filaments, generator, defect_generator, pipe_radius=50, min_length=512, max_length=512, radius_range=(1, 6), bias=0.90, preferred_direction=[1, 0, 0], cluster_centers=None, cluster_radii=None, cluster_percentages=None):
+def generate_and_count_filaments(volume, num_filaments, generator, defect_generator, pipe_radius=50, min_length=512, max_length=512, radius_range=(1, 6), bias=0.90, preferred_direction=[1, 0, 0], cluster_centers=None, cluster_radii=None, cluster_percentages=None, stats=None, free_space_sampling=False, num_voids=50, void_radius=1, threads=1, geometry=None):
+    # stats collects stage timings and rejection counters, see instrumentation.py; the
+    # resin fill and the defects run on threads threads, see parallel.py; geometry, a
+    # FilamentGeometry, records the filaments and voids, see geometry.py
+    stats = Instrumentation() if stats is None else stats
     cluster_centers = cluster_centers or [
         [120, 120, 120],
         [180, 180, 180],
@@ -88,12 +339,21 @@ def generate_and_count_filaments(volume, num_filaments, generator, defect_genera
 
     current_cluster_idx = 0
     filaments_in_cluster = 0
+    cluster_idx = None  # cluster the generator currently places filaments in, used as fiber label
+
+    # collision checks read this bit grid instead of the label volume
+    occupancy = OccupancyGrid.from_mask(is_fiber_label(volume))
+    # with free space sampling, starting points are only drawn where a sphere of the radius fits
+    free_space = None
+    if free_space_sampling:
+        free_space = FreeSpaceIndex(volume.shape, pipe_radius, range(radius_range[0], radius_range[1] + 1), is_fiber_label(volume))
 
     while successful_filaments < num_filaments and total_attempts < max_total_attempts:
         if current_cluster_idx < len(cluster_centers):
             if filaments_in_cluster < filaments_per_cluster[current_cluster_idx]:
                 generator.cluster_center = cluster_centers[current_cluster_idx]
                 generator.cluster_radius = cluster_radii[current_cluster_idx]
+                cluster_idx = current_cluster_idx
                 filaments_in_cluster += 1
             else:
                 current_cluster_idx += 1
@@ -101,6 +361,7 @@ def generate_and_count_filaments(volume, num_filaments, generator, defect_genera
         else:
             generator.cluster_center = None
             generator.cluster_radius = None
+            cluster_idx = None
         
         # uniform distribution
         # filament_radius = random.randint(radius_range[0], radius_range[1])
@@ -109,107 +370,132 @@ def generate_and_count_filaments(volume, num_filaments, generator, defect_genera
         mean = (radius_range[0] + radius_range[1]) / 2
         filament_radius = generate_radius_normal(radius_range, mean=mean, std_dev=0.5)
 
-        filament = generate_3d_filament(volume, generator, min_length, max_length, filament_radius, pipe_radius, bias, preferred_direction)
+        with stats.stage('placement'):
+            filament = generate_3d_filament(volume, generator, min_length, max_length, filament_radius, pipe_radius, bias, preferred_direction, occupancy, stats, free_space)
 
         if filament is not None:
-            update_volume_with_filament(volume, filament, filament_radius, pipe_radius, ATTENUATION_FIBER)
+            with stats.stage('stamping'):
+                update_volume_with_filament(volume, filament, filament_radius, pipe_radius, fiber_label(cluster_idx), occupancy)
+                if free_space is not None:
+                    free_space.add_filament(filament, filament_radius)
             filaments.append(filament)
+            if geometry is not None:
+                geometry.add_filament(filament, filament_radius, cluster_idx)
             successful_filaments += 1
 
         total_attempts += 1
 
+    stats.count('attempts', total_attempts)
+    stats.count('filaments', successful_filaments)
+
     if successful_filaments < num_filaments:
         print(f"Warning: Only able to place {successful_filaments} filaments after {total_attempts} attempts.")
 
-    fill_pipe_with_resin(volume, pipe_radius)
+    with stats.stage('resin_fill'):
+        fill_pipe_with_resin(volume, pipe_radius, threads)
 
-    volume = defect_generator.apply(volume)
+    with stats.stage('defects'):
+        volume = defect_generator.apply(volume, threads)
 
-    num_voids = 50  
-    add_many_small_resin_voids(volume, num_voids, pipe_radius, void_radius=1)
+    with stats.stage('voids'):
+        add_many_small_resin_voids(volume, num_voids, pipe_radius, void_radius, geometry)
     return successful_filaments, filaments
 
-def generate_3d_filament(volume, generator, min_length=512, max_length=512, filament_radius=3, pipe_radius=50, bias=0.50, preferred_direction=[1, 0, 0]):
-    starting_point = generator.initialize_starting_point(volume.shape, filament_radius)
+def generate_3d_filament(volume, generator, min_length=512, max_length=512, filament_radius=3, pipe_radius=50, bias=0.50, preferred_direction=[1, 0, 0], occupancy=None, stats=None, free_space=None, block_size=16):
+    if free_space is not None:
+        starting_point = generator.sample_starting_point(volume.shape, filament_radius, free_space)
+        if starting_point is None:
+            if stats is not None:
+                stats.count('start_rejections_full')
+            return None
+    else:
+        starting_point = generator.initialize_starting_point(volume.shape, filament_radius)
 
-    if not (is_within_bounds(starting_point, volume.shape, filament_radius) and 
-            is_within_pipe(starting_point, volume.shape[1] // 2, volume.shape[2] // 2, pipe_radius) and
-            can_place_sphere(starting_point, volume, filament_radius, pipe_radius)):
+    failure = point_failure(starting_point, volume, filament_radius, pipe_radius, occupancy)
+    if failure is not None:
+        if stats is not None:
+            stats.count(f'start_rejections_{failure}')
         return None
 
-    filament = [starting_point]
-
-    all_directions = [
-        [1, 0, 0], [1, 1, 0], [1, 0, 1], [0, 1, 1], [-1, -1, 0], [1, -1, 0],
-        [1, 0, -1], [0, 1, -1], [-1, 1, 0], [-1, 0, 1], [0, -1, 1]
-    ]
-    all_directions = [np.array(d) for d in all_directions if not np.array_equal(d, preferred_direction)]
-
-    num_biased = int(bias * 100)
-    num_other = min(100 - num_biased, len(all_directions))
-
-    biased_direction_choices = [np.array(preferred_direction)] * num_biased + random.sample(all_directions, k=num_other)
-
-    step_size = 1
-    direction = np.array(preferred_direction).astype(float)
-
-    for _ in range(max_length * 10):
-        next_point = generator.suggest_next_point(filament, direction, step_size, len(filament), max_length)
-
-        if not (is_within_bounds(next_point, volume.shape, filament_radius) and 
-                is_within_pipe(next_point, volume.shape[1] // 2, volume.shape[2] // 2, pipe_radius) and 
-                can_place_sphere(next_point, volume, filament_radius, pipe_radius)):
-            break
-
-        if generator.point_generator.grow_from_start:
-            filament.insert(0, next_point)
-        else:
-            filament.append(next_point)
-
-        if len(filament) >= max_length:
+    # the whole candidate centerline is generated up front in growth order and truncated
+    # at the first point that cannot be placed; the point generators do not use a growth
+    # direction, so bias and preferred_direction have no effect on it
+    centerline, at_start = generator.generate_centerline(starting_point, max(max_length - 1, 0))
+
+    # points are checked a block at a time in growth order, each against the voxels the
+    # capsule from the point it was grown from adds to that point's sphere, which are the
+    # voxels stamping writes; this rejects more than checking the sphere at every point
+    # would, in exchange stamped capsules never overlap fibers
+    predecessors = chain_predecessors(at_start)
+    length = len(centerline)
+    failure = 'length'  # growth stops at max_length unless a point cannot be placed
+    for block_start in range(1, len(centerline), block_size):
+        block = slice(block_start, block_start + block_size)
+        codes = step_failures(centerline[block], centerline[predecessors[block]], volume, filament_radius, pipe_radius, occupancy)
+        failed = np.flatnonzero(codes)
+        if len(failed) > 0:
+            length = block_start + failed[0]
+            failure = FAILURES[codes[failed[0]]]
             break
+    if stats is not None:
+        stats.count(f'growth_stops_{failure}')
 
+    # keep alternating the growing end across filaments as step-by-step growth would
+    if (length - 1 - (length >= max_length)) % 2:
         generator.toggle_growth_direction()
-        direction = random.choice(biased_direction_choices).astype(float)
 
-    if len(filament) < min_length:
+    if length < min_length:
+        if stats is not None:
+            stats.count('short_filaments')
         return None
 
+    centerline, at_start = centerline[:length], at_start[:length]
+    filament = list(centerline[at_start][::-1]) + list(centerline[~at_start])
     return filament
 
-def add_many_small_resin_voids(volume, num_voids, pipe_radius, void_radius=1):
-    center_y, center_z = volume.shape[1] // 2, volume.shape[2] // 2
-    voids_added = 0
+def sample_resin_voxels(volume, count, max_attempts=1000000):
+    # flat indices of count voxels drawn uniformly, with replacement, from the resin voxels;
+    # random flat indices are kept when they hit resin, so no index of all resin voxels is
+    # built unless the resin is too sparse for that to find enough of them
+    flat = volume.reshape(-1)
+    found = []
     attempts = 0
-    max_attempts = 1000000
-
-    resin_positions = np.argwhere(volume == ATTENUATION_RESIN)
-
-    if len(resin_positions) == 0:
+    while count > 0 and attempts < max_attempts:
+        batch = min(max(2 * count, 1024), max_attempts - attempts)
+        candidates = np.random.randint(0, flat.size, size=batch)
+        hits = candidates[flat[candidates] == LABEL_RESIN][:count]
+        found.append(hits)
+        count -= len(hits)
+        attempts += batch
+    if count > 0:
+        resin = np.flatnonzero(flat == LABEL_RESIN)
+        if len(resin) > 0:
+            found.append(resin[np.random.randint(0, len(resin), size=count)])
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.intp)
+
+def stamp_voids(volume, centers, pipe_radius, void_radius=1):
+    # every void in one go
+    voxels = (np.asarray(centers, dtype=np.intp).reshape(-1, 1, 3) + sphere_offsets(void_radius)).reshape(-1, 3)
+    voxels = voxels[voxels_within_bounds(voxels, volume.shape)]
+    voxels = voxels[voxels_within_pipe(voxels, volume.shape, pipe_radius)]
+    volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = LABEL_VOID
+
+def add_many_small_resin_voids(volume, num_voids, pipe_radius, void_radius=1, geometry=None):
+    # void centres are drawn from the resin before any void is added
+    centers = np.column_stack(np.unravel_index(sample_resin_voxels(volume, num_voids), volume.shape))
+    voids_added = len(centers)
+
+    if num_voids > 0 and voids_added == 0:
         print("No resin areas")
         return voids_added
 
-    while voids_added < num_voids and attempts < max_attempts:
-        random_index = random.randint(0, len(resin_positions) - 1)
-        x, y, z = resin_positions[random_index]
-
-        for i in range(-void_radius, void_radius + 1):
-            for j in range(-void_radius, void_radius + 1):
-                for k in range(-void_radius, void_radius + 1):
-                    if i**2 + j**2 + k**2 <= void_radius**2:
-                        xi, yj, zk = x + i, y + j, z + k
-                        if (0 <= xi < volume.shape[0] and
-                            0 <= yj < volume.shape[1] and
-                            0 <= zk < volume.shape[2] and
-                            is_within_pipe((xi, yj, zk), center_y, center_z, pipe_radius)):
-                            volume[xi, yj, zk] = ATTENUATION_AIR
-
-        voids_added += 1
-        attempts += 1
+    stamp_voids(volume, centers, pipe_radius, void_radius)
+    if geometry is not None:
+        geometry.add_voids(centers, void_radius)
 
     if voids_added < num_voids:
-        print(f"Warning: Only able to add {voids_added} small resin voids after {attempts} attempts.")
+        print(f"Warning: Only able to add {voids_added} small resin voids.")
     else:
         print(f"Successfully added {voids_added} small resin voids.")
 
-    return voids_added
\ No newline at end of file
+    return voids_added
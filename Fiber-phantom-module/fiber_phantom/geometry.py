@@ -0,0 +1,95 @@
+import numpy as np
+
+from fiber_phantom.materials import fiber_label
+from fiber_phantom.generate_filaments import fill_pipe_with_resin, stamp_voids, update_volume_with_filament
+
+
+class FilamentGeometry:
+    """
+    What a phantom is rasterized from, recorded while it is generated:
+        points        (P, 3) int32, the centerlines of all filaments one after the other
+        offsets       (F + 1,) int64, filament k is points[offsets[k]:offsets[k + 1]]
+        radii         (F,) int32
+        cluster_ids   (F,) int32, -1 for filaments outside of any cluster
+        void_centers  (V, 3) int32
+    together with the volume shape, the pipe radius and the void radius.
+    """
+    def __init__(self, shape, pipe_radius):
+        self.shape = tuple(shape)
+        self.pipe_radius = pipe_radius
+        self.void_radius = 0
+        self.centerlines, self.radii, self.cluster_ids = [], [], []
+        self.void_centers = np.zeros((0, 3), dtype=np.int32)
+
+    def add_filament(self, filament, radius, cluster_idx=None):
+        self.centerlines.append(np.asarray(filament, dtype=np.int32).reshape(-1, 3))
+        self.radii.append(radius)
+        self.cluster_ids.append(-1 if cluster_idx is None else cluster_idx)
+
+    def add_voids(self, centers, radius):
+        self.void_centers = np.concatenate([self.void_centers, np.asarray(centers, dtype=np.int32).reshape(-1, 3)])
+        self.void_radius = radius
+
+    def filaments(self):
+        # (centerline, radius, cluster index or None) per filament, in placement order
+        for centerline, radius, cluster_id in zip(self.centerlines, self.radii, self.cluster_ids):
+            yield centerline, radius, None if cluster_id < 0 else cluster_id
+
+    def to_arrays(self):
+        lengths = [len(centerline) for centerline in self.centerlines]
+        return {
+            "points": np.concatenate(self.centerlines) if self.centerlines else np.zeros((0, 3), dtype=np.int32),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            "radii": np.asarray(self.radii, dtype=np.int32),
+            "cluster_ids": np.asarray(self.cluster_ids, dtype=np.int32),
+            "void_centers": self.void_centers,
+            "shape": np.asarray(self.shape, dtype=np.int64),
+            "pipe_radius": np.asarray(self.pipe_radius),
+            "void_radius": np.asarray(self.void_radius),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        geometry = cls(arrays["shape"].tolist(), arrays["pipe_radius"].item())
+        offsets = arrays["offsets"]
+        geometry.centerlines = [arrays["points"][start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+        geometry.radii = arrays["radii"].tolist()
+        geometry.cluster_ids = arrays["cluster_ids"].tolist()
+        geometry.void_centers = arrays["void_centers"]
+        geometry.void_radius = arrays["void_radius"].item()
+        return geometry
+
+def read_geometry(file_path):
+    # the geometry stored in a volume_and_reconstruction_<i>.hdf5 file
+    import h5py
+    with h5py.File(file_path, "r") as h5f:
+        return FilamentGeometry.from_arrays({name: dataset[()] for name, dataset in h5f["geometry"].items()})
+
+def rasterize(geometry_file, shape=None, scale=1.0, defect_generator=None, threads=1):
+    """
+    Rebuilds the uint8 label volume of a phantom from its geometry, without placing the
+    filaments again. geometry_file is an HDF5 output file or a FilamentGeometry. Coordinates
+    and radii are multiplied by scale; shape defaults to the generated shape times scale,
+    and the pipe stays centred in it. Defects are not part of the geometry: pass the
+    DefectGenerator to apply, with parameters for the new scale. For scale 1 and the
+    generated shape and defects, the volume equals the generated one.
+    """
+    geometry = geometry_file if isinstance(geometry_file, FilamentGeometry) else read_geometry(geometry_file)
+    shape = tuple(int(round(n * scale)) for n in geometry.shape) if shape is None else tuple(shape)
+    # keeps the pipe axis at the centre of the new shape
+    offset = np.array([0,
+                       shape[1] // 2 - int(round(geometry.shape[1] // 2 * scale)),
+                       shape[2] // 2 - int(round(geometry.shape[2] // 2 * scale))])
+    pipe_radius = int(round(geometry.pipe_radius * scale))
+
+    def scaled(points):
+        return np.rint(np.asarray(points) * scale).astype(np.intp) + offset
+
+    volume = np.zeros(shape, dtype=np.uint8)
+    for centerline, radius, cluster_idx in geometry.filaments():
+        update_volume_with_filament(volume, scaled(centerline), int(round(radius * scale)), pipe_radius, fiber_label(cluster_idx))
+    fill_pipe_with_resin(volume, pipe_radius, threads)
+    if defect_generator is not None:
+        defect_generator.apply(volume, threads)
+    stamp_voids(volume, scaled(geometry.void_centers), pipe_radius, int(round(geometry.void_radius * scale)))
+    return volume
@@ -0,0 +1,64 @@
+import json
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+def peak_memory_mb():
+    # peak resident memory of this process so far (not per volume), None where unavailable
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class Instrumentation:
+    """
+    Stage timings and counters of one volume. Stages accumulate wall time in seconds:
+        placement, stamping, resin_fill, defects, voids, attenuation,
+        projection, noise, reconstruction, io
+    Counters:
+        attempts, filaments, short_filaments,
+        start_rejections_<reason>, growth_stops_<reason>
+    with reason one of bounds, pipe, collision and, for growth, length; start_rejections_full
+    counts attempts for which the free space sampler found no free centre. With a stage
+    cache, cache_hits_<stage> and cache_misses_<stage> count its lookups.
+    """
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def timed(self, name, fn):
+        # fn wrapped so its calls count towards stage name, e.g. for jobs run by a writer
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def to_dict(self):
+        return {
+            "timings": dict(self.timings),
+            "counters": dict(self.counters),
+            "peak_memory_mb": peak_memory_mb(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
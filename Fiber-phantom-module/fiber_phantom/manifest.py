@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import threading
+
+# parameters that change how a run is executed but not what it writes; a run resumed with
+# different values of these still counts the volumes written before as complete
+EXECUTION_PARAMS = {"num_volumes", "writer_threads", "max_pending_writes", "cpu_workers", "show_plots", "cache_dir", "cache_max_gb", "volume_threads"}
+
+def params_hash(params):
+    relevant = {key: value for key, value in params.items() if key not in EXECUTION_PARAMS}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+def file_sha256(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def output_record(file_path):
+    return {"sha256": file_sha256(file_path), "bytes": os.path.getsize(file_path)}
+
+def is_intact(file_path, record):
+    # a cheap check for resuming; the checksum is there to verify a dataset in full
+    return os.path.exists(file_path) and os.path.getsize(file_path) == record["bytes"]
+
+
+class Manifest:
+    """
+    JSON lines record of the volumes of a dataset whose outputs are completely written:
+        {"index", "seed", "params_hash", "outputs": {file name: {"sha256", "bytes"}}, "instrumentation"}
+    An entry is appended only after all outputs of its volume were renamed to their final
+    names, so a volume without an entry was not finished and is generated again on resume.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+    def entries(self):
+        if not os.path.exists(self.file_path):
+            return []
+        entries = []
+        with open(self.file_path, "r") as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of a run that died while appending it
+                    continue
+        return entries
+
+    def completed(self, params_hash):
+        # index -> entry of the volumes written with these parameters whose outputs are
+        # still there with their recorded size
+        directory = os.path.dirname(self.file_path)
+        completed = {}
+        for entry in self.entries():
+            if entry.get("params_hash") != params_hash:
+                continue
+            if all(is_intact(os.path.join(directory, name), record) for name, record in entry["outputs"].items()):
+                completed[entry["index"]] = entry
+        return completed
+
+    def rewrite(self, entries):
+        # through a temporary file, so a crash leaves either the old or the new manifest
+        temporary = f"{self.file_path}.{os.getpid()}.tmp"
+        with self.lock:
+            with open(temporary, "w") as file:
+                file.writelines(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.file_path)
+
+    def resume(self, params_hash):
+        # keeps only the completed entries, which also drops a torn last line that the
+        # next entry would otherwise be appended to
+        completed = self.completed(params_hash)
+        self.rewrite(completed.values())
+        return completed
+
+    def reset(self):
+        self.rewrite([])
+
+    def record(self, entry):
+        line = json.dumps(entry, sort_keys=True) + "\n"
+        with self.lock:
+            with open(self.file_path, "a") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+
+
+def merge_manifests(file_paths, target_path):
+    """
+    Combines the manifests of the shards of a dataset into one at target_path, with the
+    entries sorted by index. Raises a ValueError when the shards were generated with
+    different parameters or overlap; returns the merged entries.
+    """
+    entries = {}
+    hashes = set()
+    for file_path in file_paths:
+        for entry in Manifest(file_path).entries():
+            if entry["index"] in entries:
+                raise ValueError(f"volume {entry['index']} is recorded by more than one shard, e.g. {file_path}")
+            entries[entry["index"]] = entry
+            hashes.add(entry["params_hash"])
+    if len(hashes) > 1:
+        raise ValueError(f"the shards were generated with {len(hashes)} different parameter sets")
+
+    merged = [entries[index] for index in sorted(entries)]
+    Manifest(target_path).rewrite(merged)
+    return merged
@@ -0,0 +1,57 @@
+import numpy as np
+
+from fiber_phantom.parallel import for_each_slab
+
+# Define the attenuation coefficients
+ATTENUATION_AIR = 0.0
+ATTENUATION_RESIN = 100.0
+ATTENUATION_FIBER = 255.0
+
+# Phantoms are generated as uint8 material labels; attenuation is only looked up when
+# ASTRA or a writer needs it
+LABEL_AIR = 0
+LABEL_RESIN = 1
+LABEL_FIBER = 2  # fibers outside of any cluster
+LABEL_VOID = 3  # small voids in the resin
+LABEL_DEFECT_BASE = 8  # 8..15, one label per applied defect
+LABEL_CLUSTER_BASE = 16  # 16..255, fibers of filament cluster (label - 16)
+
+MAX_DEFECT_LABELS = LABEL_CLUSTER_BASE - LABEL_DEFECT_BASE
+MAX_CLUSTER_LABELS = 256 - LABEL_CLUSTER_BASE
+
+def defect_label(defect_index=0):
+    if not 0 <= defect_index < MAX_DEFECT_LABELS:
+        raise ValueError(f"At most {MAX_DEFECT_LABELS} defects can be labelled")
+    return LABEL_DEFECT_BASE + defect_index
+
+def fiber_label(cluster_index=None):
+    if cluster_index is None:
+        return LABEL_FIBER
+    if not 0 <= cluster_index < MAX_CLUSTER_LABELS:
+        raise ValueError(f"At most {MAX_CLUSTER_LABELS} filament clusters can be labelled")
+    return LABEL_CLUSTER_BASE + cluster_index
+
+def is_fiber_label(labels):
+    return (labels == LABEL_FIBER) | (labels >= LABEL_CLUSTER_BASE)
+
+def attenuation_table(air=ATTENUATION_AIR, resin=ATTENUATION_RESIN, fiber=ATTENUATION_FIBER):
+    # label -> attenuation lookup table; voids and defects are air
+    table = np.full(256, air, dtype=np.float32)
+    table[LABEL_RESIN] = resin
+    table[LABEL_FIBER] = fiber
+    table[LABEL_CLUSTER_BASE:] = fiber
+    return table
+
+def labels_to_attenuation(labels, table=None, out=None, chunk_size=16, threads=1):
+    # converts chunk by chunk, on threads threads, so the only temporaries are the
+    # chunks of lookup indices being converted
+    table = attenuation_table() if table is None else table
+    if len(table) != 256:
+        raise ValueError("The attenuation table needs an entry for every uint8 label")
+    out = np.empty(labels.shape, dtype=np.float32) if out is None else out
+
+    def convert(region):
+        # uint8 labels always index into the table, so 'wrap' only skips the bounds check
+        np.take(table, labels[region], out=out[region], mode='wrap')
+    for_each_slab(convert, labels.shape[0], threads, chunk_size)
+    return out
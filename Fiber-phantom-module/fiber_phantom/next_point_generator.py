@@ -8,7 +8,8 @@ class BasePointGenerator:
         self.current_point = None
         self.grow_from_start = True
 
-    def initialize_starting_point(self, volume_shape, radius, cluster_center=None, cluster_radius=None):
+    def starting_box(self, volume_shape, radius, cluster_center=None, cluster_radius=None):
+        # inclusive (low, high) ranges of x, y and z the starting point is drawn from
         if cluster_center is not None and cluster_radius is not None:
             # Calculate the bounds for x, y, and z
             lower_bound_x = max(cluster_center[0] - cluster_radius, radius)
@@ -23,34 +24,34 @@ class BasePointGenerator:
             if lower_bound_y > upper_bound_y:
                 lower_bound_y, upper_bound_y = upper_bound_y, lower_bound_y
 
-            # Avoid empty ranges by ensuring bounds are valid
-            x = lower_bound_x if lower_bound_x == upper_bound_x else random.randint(lower_bound_x, upper_bound_x)
-            y = lower_bound_y if lower_bound_y == upper_bound_y else random.randint(lower_bound_y, upper_bound_y)
-            z = random.randint(0, volume_shape[2] - 1)  # No need to change z unless there are similar issues
+            # No need to change z unless there are similar issues
+            return (lower_bound_x, upper_bound_x), (lower_bound_y, upper_bound_y), (0, volume_shape[2] - 1)
 
-        else:
-            # Default random point generation
-            x = random.randint(radius, volume_shape[0] - radius - 1)
-            y = random.randint(radius, volume_shape[1] - radius - 1)
-            z = random.randint(0, volume_shape[2] - 1)
+        # Default random point generation
+        return (radius, volume_shape[0] - radius - 1), (radius, volume_shape[1] - radius - 1), (0, volume_shape[2] - 1)
+
+    def initialize_starting_point(self, volume_shape, radius, cluster_center=None, cluster_radius=None):
+        box = self.starting_box(volume_shape, radius, cluster_center, cluster_radius)
+        # Avoid empty ranges by ensuring bounds are valid
+        x, y, z = (low if low == high else random.randint(low, high) for low, high in box)
 
         self.current_point = np.array([x, y, z])
         return self.current_point
 
+    def sample_starting_point(self, volume_shape, radius, free_space, cluster_center=None, cluster_radius=None):
+        # a starting point drawn only from the free centres of the box, None if there are none
+        point = free_space.sample(self.starting_box(volume_shape, radius, cluster_center, cluster_radius), radius)
+        if point is not None:
+            self.current_point = point
+        return point
 
-
-class CCurvePointGenerator(BasePointGenerator):
-    def __init__(self, bend_radius=100, bend_center=250, radius=3, jaggedness_factor=0.1):
-        super().__init__()
-        self.bend_radius = bend_radius
-        self.bend_center = bend_center
-        self.radius = radius
-        self.jaggedness_factor = jaggedness_factor  
+    def base_direction(self, x):
+        # unperturbed growth direction at x position(s) x, shape np.shape(x) + (3,)
+        raise NotImplementedError("Subclasses should implement this method.")
 
     def suggest_next_point(self, filament, direction, step_size, step=None, max_length=None):
         center_point = filament[0] if self.grow_from_start else filament[-1]
-        curve_effect = (center_point[0] - self.bend_center) / self.bend_radius
-        direction = np.array([1, curve_effect, 0])
+        direction = self.base_direction(center_point[0])
 
         # random perturbation added to each direction component
         jaggedness = self.jaggedness_factor * np.random.randn(*direction.shape)
@@ -64,6 +65,62 @@ class CCurvePointGenerator(BasePointGenerator):
             self.current_point = center_point + direction * self.radius
         return np.round(self.current_point).astype(int)
 
+    def growth_at_start(self, n_steps):
+        # the two ends grow alternately, beginning with the end selected by grow_from_start
+        return (np.arange(n_steps) % 2 == 0) == self.grow_from_start
+
+    def jitter(self, n_steps, rng):
+        return self.jaggedness_factor * rng.standard_normal((n_steps, 3))
+
+    def grow_chain(self, start, jitter, sign):
+        # The direction of step k only depends on the x position it grows from, so the chain
+        # is solved as a fixed point over all x positions at once: every pass fixes at least
+        # the first wrong step, and in practice two or three passes are enough.
+        if len(jitter) == 0:
+            return np.empty((0, 3), dtype=int)
+        x = start[0] + sign * self.radius * np.arange(len(jitter))
+        for _ in range(len(jitter) + 1):
+            direction = self.base_direction(x) + jitter
+            direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+            steps = np.round(sign * direction * self.radius).astype(int)
+            new_x = start[0] + np.concatenate(([0], np.cumsum(steps[:-1, 0])))
+            if np.array_equal(new_x, x):
+                break
+            x = new_x
+        return start + np.cumsum(steps, axis=0)
+
+    def generate_centerline(self, start, n_steps, rng=None):
+        """
+        Grow the whole candidate centerline of n_steps points from start in one vectorized pass,
+        the same way n_steps calls to suggest_next_point and toggle_growth_direction would.
+
+        Returns the (n_steps + 1, 3) points in growth order, starting with start, and a boolean
+        array telling which of them were grown at the start end of the filament.
+        """
+        rng = np.random if rng is None else rng
+        start = np.asarray(start, dtype=int)
+        jitter = self.jitter(n_steps, rng)
+        at_start = self.growth_at_start(n_steps)
+
+        centerline = np.empty((n_steps + 1, 3), dtype=int)
+        centerline[0] = start
+        centerline[1:][at_start] = self.grow_chain(start, jitter[at_start], -1)
+        centerline[1:][~at_start] = self.grow_chain(start, jitter[~at_start], 1)
+        return centerline, np.concatenate(([False], at_start))
+
+
+class CCurvePointGenerator(BasePointGenerator):
+    def __init__(self, bend_radius=100, bend_center=250, radius=3, jaggedness_factor=0.1):
+        super().__init__()
+        self.bend_radius = bend_radius
+        self.bend_center = bend_center
+        self.radius = radius
+        self.jaggedness_factor = jaggedness_factor  
+
+    def base_direction(self, x):
+        curve_effect = (np.asarray(x) - self.bend_center) / self.bend_radius
+        return np.stack(np.broadcast_arrays(1.0, curve_effect, 0.0), axis=-1)
+
 
 class KinkCurvePointGenerator(BasePointGenerator):
     def __init__(self, bend_center=125, transition_range=20, return_center=150, return_transition_range=20, radius=3, jaggedness_factor=0.01):
@@ -75,43 +132,21 @@ class KinkCurvePointGenerator(BasePointGenerator):
         self.radius = radius
         self.jaggedness_factor = jaggedness_factor  
 
-    def suggest_next_point(self, filament, direction, step_size, step=None, max_length=None):
-        center_point = filament[0] if self.grow_from_start else filament[-1]
-        
-        distance_from_bend = center_point[0] - self.bend_center
-        distance_from_return = center_point[0] - self.return_center
-
-        if abs(distance_from_bend) <= self.transition_range:
-            # interpolate angle between 0 and 45 degrees 
-            fraction = (distance_from_bend + self.transition_range) / (2 * self.transition_range)
-            turn_angle = fraction * 45
-        elif abs(distance_from_return) <= self.return_transition_range:
-            #  back to 0 degrees
-            fraction = (distance_from_return + self.return_transition_range) / (2 * self.return_transition_range)
-            turn_angle = 45 - (fraction * 45)
-        else:
-            turn_angle = 0  
-        
-        # conversion to radians
-        angle_radians = np.radians(turn_angle)
-        direction_x = np.cos(angle_radians)
-        direction_y = np.sin(angle_radians)
+    def base_direction(self, x):
+        distance_from_bend = np.asarray(x) - self.bend_center
+        distance_from_return = np.asarray(x) - self.return_center
 
-        direction = np.array([direction_x, direction_y, 0])
+        # interpolate angle between 0 and 45 degrees 
+        bend_fraction = (distance_from_bend + self.transition_range) / (2 * self.transition_range)
+        #  back to 0 degrees
+        return_fraction = (distance_from_return + self.return_transition_range) / (2 * self.return_transition_range)
 
-        # random perturbations
-        jaggedness = self.jaggedness_factor * np.random.randn(*direction.shape)
-        direction += jaggedness
+        turn_angle = np.where(np.abs(distance_from_bend) <= self.transition_range, bend_fraction * 45,
+                              np.where(np.abs(distance_from_return) <= self.return_transition_range, 45 - (return_fraction * 45), 0))
 
-        direction /= np.linalg.norm(direction)
-
-
-        if self.grow_from_start:
-            self.current_point = center_point - direction * self.radius
-        else:
-            self.current_point = center_point + direction * self.radius
-
-        return np.round(self.current_point).astype(int)
+        # conversion to radians
+        angle_radians = np.radians(turn_angle)
+        return np.stack(np.broadcast_arrays(np.cos(angle_radians), np.sin(angle_radians), 0.0), axis=-1)
 
 class StraightFiberPointGenerator(BasePointGenerator):
     def __init__(self, volume_shape, radius=3, jaggedness_factor=0.0):
@@ -143,6 +178,18 @@ class StraightFiberPointGenerator(BasePointGenerator):
 
         return np.round(self.current_point).astype(int)
 
+    def base_direction(self, x):
+        return np.stack(np.broadcast_arrays(1.0, np.zeros(np.shape(x)), 0.0), axis=-1)
+
+    def growth_at_start(self, n_steps):
+        # straight fibers only grow at the end
+        return np.zeros(n_steps, dtype=bool)
+
+    def jitter(self, n_steps, rng):
+        jaggedness = self.jaggedness_factor * rng.standard_normal((n_steps, 3))
+        jaggedness[:, 0] = 0
+        return jaggedness
+
 
 class FullWaveCurvePointGenerator(BasePointGenerator):
     def __init__(self, wave_center=125, wave_range=100, wave_amplitude=20, wave_frequency=3, radius=3, jaggedness_factor=0.0): 
@@ -154,34 +201,15 @@ class FullWaveCurvePointGenerator(BasePointGenerator):
         self.radius = radius
         self.jaggedness_factor = jaggedness_factor  
 
-    def suggest_next_point(self, filament, direction, step_size, step=None, max_length=None):
-        center_point = filament[0] if self.grow_from_start else filament[-1]
-        
-        distance_from_wave = center_point[0] - self.wave_center
-
-        if abs(distance_from_wave) <= self.wave_range:
-            fraction = (distance_from_wave + self.wave_range) / (2 * self.wave_range) #normalized position along the wave's range
-            turn_angle = self.wave_amplitude * np.sin(self.wave_frequency * fraction * np.pi)  # Full wave
-        else:
-            turn_angle = 0  
-        
-        angle_radians = np.radians(turn_angle)
-        direction_x = np.cos(angle_radians)
-        direction_y = np.sin(angle_radians)
-
-        direction = np.array([direction_x, direction_y, 0])
+    def base_direction(self, x):
+        distance_from_wave = np.asarray(x) - self.wave_center
 
-        jaggedness = self.jaggedness_factor * np.random.randn(*direction.shape)
-        direction += jaggedness
-
-        direction /= np.linalg.norm(direction)
+        fraction = (distance_from_wave + self.wave_range) / (2 * self.wave_range) #normalized position along the wave's range
+        turn_angle = np.where(np.abs(distance_from_wave) <= self.wave_range,
+                              self.wave_amplitude * np.sin(self.wave_frequency * fraction * np.pi), 0)  # Full wave
 
-        if self.grow_from_start:
-            self.current_point = center_point - direction * self.radius
-        else:
-            self.current_point = center_point + direction * self.radius
-
-        return np.round(self.current_point).astype(int)
+        angle_radians = np.radians(turn_angle)
+        return np.stack(np.broadcast_arrays(np.cos(angle_radians), np.sin(angle_radians), 0.0), axis=-1)
 
 class HalfWaveCurvePointGenerator(BasePointGenerator):
     def __init__(self, wave_center=125, wave_range=100, wave_amplitude=20, wave_frequency=2, radius=3, jaggedness_factor=0.0): 
@@ -193,34 +221,15 @@ class HalfWaveCurvePointGenerator(BasePointGenerator):
         self.radius = radius
         self.jaggedness_factor = jaggedness_factor  
 
-    def suggest_next_point(self, filament, direction, step_size, step=None, max_length=None):
-        center_point = filament[0] if self.grow_from_start else filament[-1]
-        
-        distance_from_wave = center_point[0] - self.wave_center
+    def base_direction(self, x):
+        distance_from_wave = np.asarray(x) - self.wave_center
 
-        if abs(distance_from_wave) <= self.wave_range:
-            fraction = (distance_from_wave + self.wave_range) / (2 * self.wave_range) 
-            turn_angle = self.wave_amplitude * np.sin(self.wave_frequency * fraction * np.pi)  
-        else:
-            turn_angle = 0  
-        
-        angle_radians = np.radians(turn_angle)
-        direction_x = np.cos(angle_radians)
-        direction_y = np.sin(angle_radians)
+        fraction = (distance_from_wave + self.wave_range) / (2 * self.wave_range) 
+        turn_angle = np.where(np.abs(distance_from_wave) <= self.wave_range,
+                              self.wave_amplitude * np.sin(self.wave_frequency * fraction * np.pi), 0)  
 
-        direction = np.array([direction_x, direction_y, 0])
-
-        jaggedness = self.jaggedness_factor * np.random.randn(*direction.shape)
-        direction += jaggedness
-
-        direction /= np.linalg.norm(direction)
-
-        if self.grow_from_start:
-            self.current_point = center_point - direction * self.radius
-        else:
-            self.current_point = center_point + direction * self.radius
-
-        return np.round(self.current_point).astype(int)
+        angle_radians = np.radians(turn_angle)
+        return np.stack(np.broadcast_arrays(np.cos(angle_radians), np.sin(angle_radians), 0.0), axis=-1)
 
 class NextPointGenerator:
     def __init__(self, mode='straight', cluster_center=None, cluster_radius=None, **kwargs):
@@ -245,8 +254,14 @@ class NextPointGenerator:
         # Pass clustering parameters to the point generator
         return self.point_generator.initialize_starting_point(volume_shape, radius, self.cluster_center, self.cluster_radius)
 
+    def sample_starting_point(self, volume_shape, radius, free_space):
+        return self.point_generator.sample_starting_point(volume_shape, radius, free_space, self.cluster_center, self.cluster_radius)
+
     def suggest_next_point(self, filament, direction, step_size, step, max_length):
         return self.point_generator.suggest_next_point(filament, direction, step_size, step, max_length)
 
+    def generate_centerline(self, start, n_steps, rng=None):
+        return self.point_generator.generate_centerline(start, n_steps, rng)
+
     def toggle_growth_direction(self):
         self.point_generator.grow_from_start = not self.point_generator.grow_from_start
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class OccupancyGrid:
+    # Bit-packed record of the voxels taken by fibers, kept apart from the attenuation
+    # volume so collision checks read 1 bit per voxel instead of a float32.
+    # Bits are packed along z in np.packbits order (most significant bit first).
+    def __init__(self, volume_shape):
+        self.shape = tuple(volume_shape)
+        self.bits = np.zeros((self.shape[0], self.shape[1], (self.shape[2] + 7) // 8), dtype=np.uint8)
+
+    @classmethod
+    def from_mask(cls, mask):
+        grid = cls(mask.shape)
+        grid.bits = np.packbits(mask, axis=2)
+        return grid
+
+    def to_mask(self):
+        return np.unpackbits(self.bits, axis=2, count=self.shape[2]).astype(bool)
+
+    @staticmethod
+    def _locate(voxels):
+        # voxels is an (N, 3) integer array of in-bounds coordinates
+        z = voxels[:, 2]
+        return (voxels[:, 0], voxels[:, 1], z >> 3), (0x80 >> (z & 7)).astype(np.uint8)
+
+    def any(self, voxels):
+        index, bit = self._locate(voxels)
+        return bool(np.any(self.bits[index] & bit))
+
+    def contains(self, voxels):
+        # per voxel: is its bit set
+        index, bit = self._locate(voxels)
+        return (self.bits[index] & bit) != 0
+
+    def region_mask(self, x, y, z):
+        # unpacked bool mask of the box given by three slices with a step of 1
+        bits = self.bits[x, y, z.start // 8:(z.stop + 7) // 8]
+        return np.unpackbits(bits, axis=2)[:, :, z.start % 8:z.start % 8 + z.stop - z.start].astype(bool)
+
+    def mark_region(self, origin, mask):
+        # sets the bits of the box at origin where the bool mask is True; the box must lie
+        # within the grid
+        x, y, z = origin
+        pad = z % 8
+        packed = np.packbits(np.pad(mask, ((0, 0), (0, 0), (pad, 0))), axis=2)
+        self.bits[x:x + mask.shape[0], y:y + mask.shape[1], z // 8:z // 8 + packed.shape[2]] |= packed
+
+    def mark(self, voxels):
+        # several voxels can share a byte, so the bits are or-ed in unbuffered
+        index, bit = self._locate(voxels)
+        np.bitwise_or.at(self.bits, index, bit)
@@ -0,0 +1,33 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# The whole-volume passes of a single volume (resin fill, defects, label -> attenuation)
+# run over disjoint x slabs on a thread pool. The volume stays one array shared by the
+# threads, and the numpy calls doing the work release the GIL, so the slabs are processed
+# on all cores.
+
+def default_threads(threads):
+    return threads or os.cpu_count() or 1
+
+def x_slabs(length, count):
+    # count near equal, disjoint slices covering range(length)
+    count = max(1, min(count, length))
+    edges = [length * k // count for k in range(count + 1)]
+    return [slice(start, stop) for start, stop in zip(edges[:-1], edges[1:])]
+
+def for_each_slab(fn, length, threads=1, width=None):
+    # calls fn(x slice) for slabs of at most width x slices or, without a width, a few
+    # slabs per thread so that uneven work still balances; fn must only write to its slab
+    threads = default_threads(threads)
+    if width:
+        count = -(-length // width)
+    else:
+        count = 4 * threads if threads > 1 else 1
+    slabs = x_slabs(length, count)
+    if threads == 1 or len(slabs) == 1:
+        for slab in slabs:
+            fn(slab)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # list() re-raises the first exception of any slab
+        list(pool.map(fn, slabs))
@@ -1,11 +1,13 @@
 import astra
 import numpy as np
-import pylab
-import matplotlib.pyplot as plt
-import nibabel as nib
-import scipy.optimize as sco
+from concurrent.futures import ProcessPoolExecutor
+
+import fiber_phantom.cpu_tomography as cpu
+from fiber_phantom.instrumentation import Instrumentation
+from fiber_phantom.cache import NullCache
 
 def save_as_nifti(array, file_path): # for 3D Slicer visualization
+    import nibabel as nib
     nifti_img = nib.Nifti1Image(array, affine=np.eye(4))  
     nib.save(nifti_img, file_path)
 
@@ -56,49 +58,217 @@ def save_as_nifti(array, file_path): # for 3D Slicer visualization
 #     return results['original'], results['noisy']
 
 # Estimate the absorption factor based on average absorption ratio
-def estimate_absorption_factor(projections, average_absorption_ratio):
-    projs = projections[projections > 0]  
+def estimate_absorption_factor(projections, average_absorption_ratio, bins=4096, tol=1e-10, max_iter=100):
+    """
+    Solve 1 - mean(exp(-fac * p)) = average_absorption_ratio over the positive projection
+    values p. The ratio increases monotonically with fac, so the root is found by Newton
+    steps safeguarded by bisection, on a histogram of p instead of the full sinogram.
+    Replacing every value by its bin centre moves the ratio by at most fac * bin_width / 2,
+    with bin_width = max(p) / bins.
+    """
+    projs = projections[projections > 0]
+    if projs.size == 0:
+        return 1.0  # nothing absorbs, any factor gives the same (noise-free) counts
 
-    def error_function(fac):
-        rat = 1 - np.exp(-projs * fac[0]).mean()
-        return (rat - average_absorption_ratio) ** 2
-    
-    return sco.fmin(error_function, 1, disp=False)[0]
+    counts, edges = np.histogram(projs, bins=bins, range=(0, float(projs.max())))
+    keep = counts > 0
+    weights = counts[keep] / projs.size
+    values = ((edges[:-1] + edges[1:]) / 2)[keep]
+
+    def ratio_and_slope(fac):
+        transmitted = weights * np.exp(-fac * values)
+        return 1 - transmitted.sum(), (values * transmitted).sum()
+
+    # bracket the root; ratio(0) = 0 and ratio grows towards 1
+    low, high = 0.0, 1.0
+    while ratio_and_slope(high)[0] < average_absorption_ratio and high < 1e12:
+        low, high = high, high * 2
 
+    fac = (low + high) / 2
+    for _ in range(max_iter):
+        ratio, slope = ratio_and_slope(fac)
+        error = ratio - average_absorption_ratio
+        if abs(error) < tol:
+            break
+        if error < 0:
+            low = fac
+        else:
+            high = fac
+        step = fac - error / slope if slope > 0 else None
+        fac = step if step is not None and low < step < high else (low + high) / 2
+    return fac
 
-def perform_tomography(volume, volume_dimensions, num_angles, geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, i0, algorithm, show_plots, source_origin, origin_det):
-    vol_geom = astra.create_vol_geom(volume_dimensions)
-    angles = np.linspace(0, np.pi, num_angles, False)
-    proj_geom = astra.create_proj_geom(geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, angles, source_origin, origin_det)
-    proj_id_original, proj_data_original = astra.create_sino3d_gpu(volume, proj_geom, vol_geom)
 
+def noise_model(proj_data):
+    # absorption factor and transmission of the clean sinogram, shared by every dose level
     avg_absorption_ratio = 0.5
-    absorption_factor = estimate_absorption_factor(proj_data_original, avg_absorption_ratio)
+    absorption_factor = estimate_absorption_factor(proj_data, avg_absorption_ratio)
+    return absorption_factor, np.exp(-absorption_factor * proj_data)
 
-    virtual_photon_count = i0 * np.exp(-absorption_factor * proj_data_original)
-    noisy_virtual_photon_counts = np.random.poisson(virtual_photon_count)
+def noise_rng(seed, i0, realization):
+    # without a seed the global numpy generator; with one, a generator per dose level and
+    # realization, so any of them can be drawn (or cached) on its own
+    if seed is None:
+        return np.random
+    i0_words = np.frombuffer(np.float64(i0).tobytes(), dtype=np.uint32)
+    return np.random.RandomState([seed, realization, *i0_words])
+
+def noisy_sinogram(model, i0, rng=np.random):
+    absorption_factor, transmission = model
+    noisy_virtual_photon_counts = rng.poisson(i0 * transmission)
     noisy_virtual_photon_counts[noisy_virtual_photon_counts == 0] = 1  # Avoid log(0)
-    proj_data_noisy = -np.log(noisy_virtual_photon_counts / i0) / absorption_factor
-
-    rec_id_original, rec_id_noisy = [astra.data3d.create('-vol', vol_geom) for _ in range(2)]
-    cfgs = {
-        'original': {'ReconstructionDataId': rec_id_original, 'ProjectionDataId': proj_id_original},
-        'noisy': {'ReconstructionDataId': rec_id_noisy, 'ProjectionDataId': astra.data3d.create('-sino', proj_geom, proj_data_noisy)}
-    }
-
-
-    results = {}
-    for key, cfg in cfgs.items():
-        cfg_alg = astra.astra_dict(algorithm)
-        cfg_alg.update(cfg)
-        alg_id = astra.algorithm.create(cfg_alg)
-        astra.algorithm.run(alg_id, 200)
-        rec = astra.data3d.get(cfg['ReconstructionDataId'])
-        results[key] = rec
-        astra.algorithm.delete(alg_id)
-        astra.data3d.delete(cfg['ReconstructionDataId'])
-        astra.data3d.delete(cfg['ProjectionDataId'])
-
-    astra.data3d.delete(proj_id_original)
-    
-    return results['original'], results['noisy']
\ No newline at end of file
+    return -np.log(noisy_virtual_photon_counts / i0) / absorption_factor
+
+
+class TomographySession:
+    """
+    ASTRA geometries and buffers for a whole run, since the scan geometry is the same for
+    every volume. With the 'cuda' backend the phantom, sinogram and reconstruction data3d
+    buffers are allocated once and refilled in place with astra.data3d.store; with the 'cpu'
+    backend the session keeps its process pool. close() releases everything.
+    """
+    def __init__(self, volume_dimensions, num_angles, geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, algorithm, source_origin, origin_det, backend='cuda', workers=None, iterations=200):
+        if backend not in ('cuda', 'cpu'):
+            raise ValueError(f"Unknown tomography backend: {backend}")
+        if backend == 'cpu' and geometry_type != 'parallel3d':
+            raise ValueError("The CPU backend only supports 'parallel3d' geometry")
+
+        self.backend = backend
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.workers = workers
+        self.det_width_u, self.det_width_v = det_width_u, det_width_v
+        self.det_count_x, self.det_count_y = det_count_x, det_count_y
+        # what the sinogram and the reconstructions depend on, for the stage cache keys
+        self.scan_params = dict(volume_dimensions=list(volume_dimensions), num_angles=num_angles, geometry_type=geometry_type,
+                                det_width_u=det_width_u, det_width_v=det_width_v, det_count_x=det_count_x, det_count_y=det_count_y,
+                                source_origin=source_origin, origin_det=origin_det, backend=backend)
+        self.reconstruction_params = dict(algorithm=algorithm, iterations=iterations, backend=backend)
+        self.angles = np.linspace(0, np.pi, num_angles, False)
+        self.vol_geom = astra.create_vol_geom(volume_dimensions)
+        self.proj_geom = astra.create_proj_geom(geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, self.angles, source_origin, origin_det)
+
+        self.volume_id = None
+        self.sino_ids, self.rec_ids = {}, {}
+        self.executor = None
+        self.projection = None  # sinogram held by the 'original' buffer
+        if backend == 'cuda':
+            try:
+                self.volume_id = astra.data3d.create('-vol', self.vol_geom)
+                for key in ('original', 'noisy'):
+                    self.sino_ids[key] = astra.data3d.create('-sino', self.proj_geom)
+                    self.rec_ids[key] = astra.data3d.create('-vol', self.vol_geom)
+            except BaseException:
+                self.close()
+                raise
+        else:
+            # one pool serves every forward projection and reconstruction of the run
+            self.executor = ProcessPoolExecutor(max_workers=cpu.default_workers(workers))
+
+    def run_algorithm(self, cfg):
+        alg_id = astra.algorithm.create(cfg)
+        try:
+            astra.algorithm.run(alg_id, self.iterations)
+        finally:
+            astra.algorithm.delete(alg_id)
+
+    def forward_project(self, volume):
+        if self.backend == 'cpu':
+            return cpu.create_sino3d_cpu(volume, self.angles, self.det_width_u, self.det_width_v, self.det_count_x, self.det_count_y, self.workers, self.executor)
+
+        astra.data3d.store(self.volume_id, volume)
+        cfg = astra.astra_dict('FP3D_CUDA')
+        cfg['VolumeDataId'] = self.volume_id
+        cfg['ProjectionDataId'] = self.sino_ids['original']
+        self.run_algorithm(cfg)
+        self.projection = astra.data3d.get(self.sino_ids['original'])
+        return self.projection
+
+    def reconstruct(self, proj_data, key, volume_shape):
+        if self.backend == 'cpu':
+            return cpu.reconstruct3d_cpu(proj_data, volume_shape, self.angles, self.det_width_u, self.det_width_v, self.algorithm, self.iterations, self.workers, self.executor)
+
+        # the 'original' buffer already holds the last forward projection, unless proj_data
+        # came from elsewhere, e.g. the stage cache
+        if key != 'original' or proj_data is not self.projection:
+            astra.data3d.store(self.sino_ids[key], np.asarray(proj_data, dtype=np.float32))
+        astra.data3d.store(self.rec_ids[key], 0)  # iterative algorithms start from the buffer
+        cfg = astra.astra_dict(self.algorithm)
+        cfg['ReconstructionDataId'] = self.rec_ids[key]
+        cfg['ProjectionDataId'] = self.sino_ids[key]
+        self.run_algorithm(cfg)
+        return astra.data3d.get(self.rec_ids[key])
+
+    def run(self, volume, i0, return_sinograms=False, stats=None, seed=None, cache=None, key=None):
+        original, noisy, proj_data_original = self.run_sweep(volume, [i0], 1, return_sinograms, stats, seed, cache, key)
+        _, _, noisy_reconstruction, proj_data_noisy = noisy[0]
+        if return_sinograms:
+            return original, noisy_reconstruction, proj_data_original, proj_data_noisy
+        return original, noisy_reconstruction
+
+    def run_sweep(self, volume, i0_values, realizations=1, return_sinograms=False, stats=None, seed=None, cache=None, key=None):
+        """
+        One forward projection and clean reconstruction, then a noisy reconstruction for
+        every i0 in i0_values, realizations times each. Returns the clean reconstruction,
+        a list of (i0, realization, noisy reconstruction, noisy sinogram or None) and the
+        clean sinogram (or None).
+        seed gives every noise realization its own generator; without it the noise comes
+        from the global numpy generator. With a StageCache and the phantom's cache key, every
+        stage is looked up before it is computed; the noise is only cached with a seed.
+        stats accumulates the projection, noise and reconstruction times.
+        """
+        stats = Instrumentation() if stats is None else stats
+        cache = NullCache() if cache is None or key is None else cache
+
+        sinogram_key = cache.key('sinogram', self.scan_params, key)
+        with stats.stage('projection'):
+            proj_data_original = cache.fetch(sinogram_key, lambda: self.forward_project(volume), stats)
+        with stats.stage('reconstruction'):
+            original = cache.fetch(cache.key('reconstruction', self.reconstruction_params, sinogram_key),
+                                   lambda: self.reconstruct(proj_data_original, 'original', volume.shape), stats)
+
+        model = []  # noise model, only computed once a noisy sinogram is not cached
+
+        def draw(i0, realization):
+            if not model:
+                model.append(noise_model(proj_data_original))
+            return noisy_sinogram(model[0], i0, noise_rng(seed, i0, realization))
+
+        noisy = []
+        for i0 in i0_values:
+            for realization in range(realizations):
+                noisy_key = cache.key('noisy_sinogram', dict(i0=i0, realization=realization, seed=seed),
+                                      sinogram_key if seed is not None else None)
+                with stats.stage('noise'):
+                    proj_data_noisy = cache.fetch(noisy_key, lambda: draw(i0, realization), stats)
+                with stats.stage('reconstruction'):
+                    reconstruction = cache.fetch(cache.key('reconstruction', self.reconstruction_params, noisy_key),
+                                                 lambda: self.reconstruct(proj_data_noisy, 'noisy', volume.shape), stats)
+                noisy.append((i0, realization, reconstruction, proj_data_noisy if return_sinograms else None))
+
+        return original, noisy, proj_data_original if return_sinograms else None
+
+    def close(self):
+        ids = [i for i in [self.volume_id, *self.sino_ids.values(), *self.rec_ids.values()] if i is not None]
+        self.volume_id = None
+        self.sino_ids, self.rec_ids = {}, {}
+        if ids:
+            astra.data3d.delete(ids)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def perform_tomography(volume, volume_dimensions, num_angles, geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, i0, algorithm, show_plots, source_origin, origin_det, return_sinograms=False, backend='cuda', workers=None):
+    # backend 'cuda' runs ASTRA's 3D GPU algorithms, 'cpu' splits parallel3d scans into 2D slices
+    # reconstructed on ASTRA's CPU projectors across a pool of worker processes.
+    # For many volumes, keep one TomographySession open instead.
+    with TomographySession(volume_dimensions, num_angles, geometry_type, det_width_u, det_width_v, det_count_x, det_count_y, algorithm, source_origin, origin_det, backend, workers) as session:
+        return session.run(volume, i0, return_sinograms)
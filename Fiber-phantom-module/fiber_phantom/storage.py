@@ -0,0 +1,173 @@
+import os
+import json
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+from fiber_phantom.materials import attenuation_table
+
+# gzip with byte shuffling; the label volume compresses to a small fraction of its size
+COMPRESSION = dict(compression="gzip", compression_opts=4, shuffle=True)
+
+def chunk_shape(shape, slab=8, tile=64):
+    # slabs of a few x slices split into tiles, so reading a single slice or a small
+    # 3D patch only decompresses a handful of chunks
+    return (min(slab, shape[0]),) + tuple(min(tile, n) for n in shape[1:])
+
+def to_attribute(value):
+    # numbers, booleans, strings and numeric lists are stored with their own type; nested
+    # structures such as the defect parameter lists are stored as JSON strings
+    if isinstance(value, (bool, int, float, str, np.generic)):
+        return value
+    if isinstance(value, (list, tuple)) and len(value) > 0:
+        array = np.asarray(value) if all(isinstance(v, (bool, int, float)) for v in value) else None
+        if array is not None and array.dtype.kind in "biuf":
+            return array
+    return json.dumps(value)
+
+def temporary_path(file_path):
+    # in the same directory, so the rename is atomic, and with the same extension, which
+    # nibabel picks the file format by
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f".tmp-{os.getpid()}-{name}")
+
+def remove_temporary_files(file_path):
+    # left behind for file_path by interrupted writes; several processes can share a
+    # directory as long as they write different files, e.g. the shards of a dataset
+    directory, name = os.path.split(file_path)
+    for entry in os.listdir(directory or "."):
+        if entry.startswith(".tmp-") and entry.split("-", 2)[2] == name:
+            os.remove(os.path.join(directory, entry))
+
+def atomic_write(file_path, write):
+    # write(path) writes to a temporary file that is renamed to file_path once complete, so
+    # an interrupted run never leaves a partial file under the final name
+    remove_temporary_files(file_path)
+    temporary = temporary_path(file_path)
+    try:
+        write(temporary)
+        os.replace(temporary, file_path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def write_dataset(group, name, data):
+    data = np.asarray(data)
+    return group.create_dataset(name, data=data, chunks=chunk_shape(data.shape), **COMPRESSION)
+
+def write_array(group, name, data):
+    # the small arrays of the geometry, chunked as h5py sees fit; scalars and empty arrays
+    # cannot be compressed
+    data = np.asarray(data)
+    if data.ndim == 0 or data.size == 0:
+        return group.create_dataset(name, data=data)
+    return group.create_dataset(name, data=data, chunks=True, **COMPRESSION)
+
+def write_volume_hdf5(file_path, phantom, params, random_seed, reconstructions=None, sinograms=None, table=None, dataset_attrs=None, stats=None, geometry=None):
+    """
+    Write one volume of the dataset as chunked, compressed datasets:
+        phantom                   uint8 material labels, with the label -> attenuation table as attribute
+        reconstruction/<name>     e.g. clean and noisy reconstructions
+        sinogram/<name>           optional projection data
+        geometry/<name>           optional filament centerlines and voids, see geometry.py
+    The parameters are stored as typed attributes of the file; dataset_attrs maps a
+    reconstruction/sinogram name to attributes of that dataset, e.g. its i0. stats, an
+    Instrumentation, is stored as JSON in the 'instrumentation' attribute.
+    """
+    import h5py  # imported on first use, keeps worker startup light
+    with h5py.File(file_path, "w") as h5f:
+        for key, value in params.items():
+            h5f.attrs[key] = to_attribute(value)
+        h5f.attrs["random_seed"] = int(random_seed)
+        if stats is not None:
+            # serialized here, after the writes queued before this one have finished
+            h5f.attrs["instrumentation"] = stats.to_json()
+
+        dataset = write_dataset(h5f, "phantom", phantom)
+        dataset.attrs["attenuation_table"] = attenuation_table() if table is None else table
+
+        for group_name, arrays in (("reconstruction", reconstructions), ("sinogram", sinograms)):
+            if arrays:
+                group = h5f.create_group(group_name)
+                for name, array in arrays.items():
+                    dataset = write_dataset(group, name, array)
+                    for key, value in (dataset_attrs or {}).get(name, {}).items():
+                        dataset.attrs[key] = to_attribute(value)
+
+        if geometry is not None:
+            group = h5f.create_group("geometry")
+            for name, array in geometry.to_arrays().items():
+                write_array(group, name, array)
+
+
+class AsyncWriter:
+    """
+    Runs write jobs on background threads so the next volume can be generated while the
+    previous one is written. The queue is bounded: submit blocks once max_pending jobs are
+    waiting, which bounds the memory held by arrays queued for writing.
+    The first error raised by a job is re-raised by the next submit, flush or close.
+    submit returns a Future of the job's result.
+    """
+    def __init__(self, num_threads=1, max_pending=4):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                future, fn, args, kwargs = job
+                # once a job failed the remaining ones are dropped; cancel alone does not
+                # wake threads already in concurrent.futures.wait on the future
+                if self.errors:
+                    future.cancel()
+                    future.set_running_or_notify_cancel()
+                else:
+                    future.set_result(fn(*args, **kwargs))
+            except BaseException as error:
+                self.errors.append(error)
+                future.set_exception(error)
+            finally:
+                self.queue.task_done()
+
+    def _raise_if_failed(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_if_failed()
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def flush(self):
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not mask the error that is already propagating
+            try:
+                self.close()
+            except BaseException:
+                pass
+        return False
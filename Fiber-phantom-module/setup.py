@@ -9,6 +9,7 @@ setup(
     author='MC, Daan, Joost',
     author_email='marychrismcr@liacs.leidenuniv.nl',
     packages=find_packages(include=['fiber_phantom', 'fiber_phantom.*']),
+    package_data={'fiber_phantom': ['parameters.json']},
     install_requires=[
         'numpy==1.24.2',
         'h5py==3.8.0',
@@ -19,7 +20,7 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'fiber_phantom=fiber_phantom.main:main',
+            'fiber-phantom=fiber_phantom.cli:main',
         ],
     },
 )